@@ -0,0 +1,95 @@
+__all__ = ("CLASS_PRECEDENCE",
+           "UNCLASSIFIED",
+           "classify",
+           "classify_many",
+           )
+
+from itertools import product
+from typing import Any, Dict, Iterable, List, NamedTuple, Tuple
+from core.roles import resolve_role, EDGE_ROLES, CORE_ROLES, AGGREGATE_ROLES, BORDER_ROLES, CACHE_ROLES
+
+
+UNCLASSIFIED = 'unclassified'
+
+# role group of every known CMDB role, other roles have no group
+ROLE_GROUPS: Dict[str, str] = {
+    **{role: 'edge' for role in EDGE_ROLES},
+    **{role: 'core' for role in CORE_ROLES},
+    **{role: 'aggregate' for role in AGGREGATE_ROLES},
+    **{role: 'border' for role in BORDER_ROLES},
+    **{role: 'cache' for role in CACHE_ROLES},
+}
+_GROUPS = (*sorted(set(ROLE_GROUPS.values())), None)
+
+
+class _Key(NamedTuple):
+    peer_link: bool
+    group_h: str | None
+    group_p: str | None
+    spine_h: bool
+    leaf_h: bool
+    spine_p: bool
+    leaf_p: bool
+
+
+def _pairs(*pairs: Tuple[str, str]):
+    return lambda k: (k.group_h, k.group_p) in pairs
+
+
+# the first matching class wins
+CLASS_RULES = (
+    ('peer_uplink', lambda k: k.peer_link),
+    ('aggregate_spine', lambda k: (k.group_h == 'aggregate' and k.spine_p) or (k.spine_h and k.group_p == 'aggregate')),
+    ('spine_leaf', lambda k: (k.spine_h and k.leaf_p) or (k.leaf_h and k.spine_p)),
+    ('core_aggregate__access', _pairs(('edge', 'core'), ('core', 'edge'),
+                                      ('edge', 'aggregate'), ('aggregate', 'edge'))),
+    ('core__cache', _pairs(('core', 'cache'), ('cache', 'core'))),
+    ('core_aggregate_border', _pairs(('core', 'aggregate'), ('aggregate', 'core'),
+                                     ('core', 'border'), ('border', 'core'),
+                                     ('core', 'core'), ('border', 'border'))),
+)
+CLASS_PRECEDENCE = tuple(class_name for class_name, _ in CLASS_RULES)
+
+
+def _compile() -> Dict[_Key, str]:
+    flags = (False, True)
+    table = {}
+    for key in map(_Key._make, product(flags, _GROUPS, _GROUPS, flags, flags, flags, flags)):
+        table[key] = next((class_name for class_name, rule in CLASS_RULES if rule(key)), UNCLASSIFIED)
+    return table
+
+
+# every combination of the inputs the rules look at, about a thousand entries
+_CLASS_TABLE = _compile()
+
+
+def _key(hostname: str, peer: str, link_type: str, role_h: str | None, role_p: str | None) -> _Key:
+    return _Key(link_type == 'P',
+                ROLE_GROUPS.get(role_h),
+                ROLE_GROUPS.get(role_p),
+                'spine' in hostname, 'leaf' in hostname,
+                'spine' in peer, 'leaf' in peer)
+
+
+def classify(hostname: str, peer: str, link_type: str, role_h: str | None, role_p: str | None) -> Tuple[str, str, str]:
+    """Returns (classname, effective role_h, effective role_p) of an incident."""
+    role_h, role_p = resolve_role(role_h), resolve_role(role_p)
+    return _CLASS_TABLE[_key(hostname or '', peer or '', link_type, role_h, role_p)], role_h, role_p
+
+
+def classify_many(incidents: Iterable[Any], hosts: Any = None) -> List[Tuple[str, str, str]]:
+    """classify for a batch of incident dicts or models, in the same order.
+
+    `hosts` is a mapping like services.host_index: the roles it has resolved are used, the
+    role strings of the incident only for hosts missing from it.
+    """
+    results = []
+    for incident in incidents:
+        get = incident.get if isinstance(incident, dict) else lambda field: getattr(incident, field)
+        role_h, role_p = get('role_h'), get('role_p')
+        if hosts is not None:
+            host, peer = hosts.get(get('hostname')), hosts.get(get('peer'))
+            role_h = host.role if host is not None else role_h
+            role_p = peer.role if peer is not None else role_p
+        results.append(classify(get('hostname'), get('peer'), get('link_type'), role_h, role_p))
+    return results
@@ -1,49 +1,47 @@
 from __future__ import annotations
 
+import os
+import socket
 import asyncio
 
 from abc import ABC, abstractmethod
-from services.services import incident_service, network_service
+from services.services import incident_service, click_service
 from db.models import Incidents
 from enum import Enum
+from core.classifier import classify_many
 from sqlmodel import SQLModel
 from typing import List, Dict, Any
 from datetime import datetime, timedelta
 from core.logger import logger
-from core.mt_bot import send_msg as mt_send_msg
+from core.journal import stage_journal, record_stage
+from core.redis_client import dedup_index
+from services.host_index import host_index
+from network.batcher import port_batcher
+from core.notifier import notifier
 from core.tg_bot import send_msg as tg_send_msg
 from config.env import *
+from config import CONFIG
 
 
 __all__ = (
     "start_handler",
 )
 
+# incidents handled at once, device access is serialized per switch by network.sessions
+HANDLER_CONCURRENCY = CONFIG.get('handler', {}).get('concurrency') or 20
+# incidents leased per run, the lease must outlive a chain run
+CLAIM_BATCH = CONFIG.get('handler', {}).get('claim_batch') or 200
+LEASE_SECONDS = CONFIG.get('handler', {}).get('lease_seconds') or 300
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}"
+# p99 load a sibling link may carry once the port is shut down, no limit if not set
+BANDWIDTH_LIMIT = CONFIG.get('handler', {}).get('bandwidth_limit')
+# ports are really shut down only with access to the network
+NETWORK_ENABLED = CONFIG.get('network', {}).get('enabled', False)
+# driver of ConnectionFabric: 'juniper_junos' (CLI over SSH) or 'juniper_netconf'
+NETWORK_DEVICE_TYPE = CONFIG.get('network', {}).get('device_type') or 'juniper_junos'
 
-class Role(Enum):
-    core = 100
-    aggregate = 40
-    border = 30
-    spine = 20
-    edge = 10
-    leaf = 10
-    cache = 10
-    peer = 1
-    uplink = 1
-    office = 1
-    unclassified = 0
-
-    def __gt__(self, other):
-        return self.value > other.value
-
-    def __lt__(self, other):
-        return self.value < other.value
-
-    def __eq__(self, other):
-        return self.value == other.value
-
-    def __get__(self, item):
-        return self.value
+# shared by the overlapping runs of cron, listener and pipeline, created in the running loop
+_semaphore: asyncio.Semaphore | None = None
 
 
 class AbstractHandler(ABC):
@@ -96,10 +94,10 @@ class ClassifiedSingleHandler(BaseHandler):
         logger.info(f'Incident__in_handle: [{type(incident_item)}] {incident_item}')
         incident_model = Incidents.sqlmodel_update(Incidents(), obj=incident_item)
         incident_model = self._set_incident_classname(incident_model)
-        incident_model.stage = self.stage
         incident_model.running = True
         logger.info(f"incident_model: [{type(incident_model)}] {incident_model}")
-        result_update = await incident_service().update(incident_model)
+        result_update = await record_stage(incident_model, self.stage,
+                                           fields=('classname', 'role_h', 'role_p', 'running'))
         logger.info(f'Incident classificator has completed. '
                     f'{self.__class__.__name__}: {incident_model}. '
                     f'Continue checking...')
@@ -109,66 +107,23 @@ class ClassifiedSingleHandler(BaseHandler):
 
     @staticmethod
     def _set_incident_classname(incident) -> Incidents:
-        incident.classname = HandlerClasses.unclassified.name
-        edge_roles = ('edge', 'edge_minion', 'ddos_edge', 'edge_hadoop', 'edge_hosting', 'ext_edge')
-        core_roles = ('core', 'ext_core', 'core_tarm_lan', 'core_p')
-        aggregate_roles = ('aggregate', 'aggregate_hosting')
-        border_roles = ('border',)
-        cache_roles = ('cache',)
-        all_roles = edge_roles + core_roles + aggregate_roles + border_roles
-        role_h = incident.role_h
-        role_p = incident.role_p
-
-        if len(role_h.split(',')) > 1:
-            role_h = Role(max(Role[role].value if role in all_roles else 0 for role in role_h.split(','))).name
-            incident.role_h = role_h
-
-        if len(role_p.split(',')) > 1:
-            role_p = Role(max(Role[role].value if role in all_roles else 0 for role in role_p.split(','))).name
-            incident.role_p = role_p
-
-        conditions_mapping = {
-            (HandlerClasses.peer_uplink.name, lambda: incident.link_type == 'P'),
-            (HandlerClasses.aggregate_spine.name, lambda: (role_h in aggregate_roles and 'spine' in incident.peer) or
-                                                          ('spine' in incident.hostname and role_p in aggregate_roles)),
-            (HandlerClasses.spine_leaf.name, lambda: ('spine' in incident.hostname and 'leaf' in incident.peer) or
-                                                     ('leaf' in incident.hostname and 'spine' in incident.peer)),
-            (HandlerClasses.core_aggregate__access.name, lambda: (role_h in edge_roles and role_p in core_roles) or
-                                                                 (role_h in core_roles and role_p in edge_roles) or
-                                                                 (role_h in edge_roles and role_p in aggregate_roles) or
-                                                                 (role_h in aggregate_roles and role_p in edge_roles)),
-            (HandlerClasses.core__cache.name, lambda: (role_h in core_roles and role_p in cache_roles) or
-                                                      (role_h in cache_roles and role_p in core_roles)),
-            (HandlerClasses.core_aggregate_border.name, lambda: (role_h in core_roles and role_p in aggregate_roles) or
-                                                                (role_h in aggregate_roles and role_p in core_roles) or
-                                                                (role_h in core_roles and role_p in border_roles) or
-                                                                (role_h in border_roles and role_p in core_roles) or
-                                                                (role_h in core_roles and role_p in core_roles) or
-                                                                (role_h in core_roles and role_p in core_roles) or
-                                                                (role_h in border_roles and role_p in border_roles)),
-        }
-
-        for class_name, condition_func in conditions_mapping:
-            if condition_func():
-                logger.info(f"Incident classname: {class_name}")
-                incident.classname = class_name
-                break
-
+        # start_handler classifies the claimed batch at once, see core.classifier
+        if incident.classname not in HandlerClasses.__members__:
+            incident.classname, incident.role_h, incident.role_p = classify_many([incident], host_index)[0]
+        logger.info(f"Incident classname: {incident.classname}")
         return incident
 
 
 class CheckIncidentExistHandler(BaseHandler):
     stage = 'existence_check'
 
-    # dummy
     async def handle(self, inc_model: SQLModel):
         logger.info(f'{self.__class__.__name__}: start...')
-        is_exist_incident = False
+        is_exist_incident = await incident_service().is_duplicate(inc_model)
         if is_exist_incident:
             logger.info(f'{self.__class__.__name__}: found duplicate incident in database')
             return None
-        inc_model.stage = self.stage
-        result = await incident_service().update(inc_model)
+        result = await record_stage(inc_model, self.stage)
         logger.info(f'{self.__class__.__name__}: incident is not found in database. Continue...')
         return await super().handle(inc_model)
 
@@ -176,24 +131,39 @@ class CheckIncidentExistHandler(BaseHandler):
 class CheckBandwidthHandler(BaseHandler):
     stage = 'bandwidth_check'
 
-    # dummy
     async def handle(self, inc_model: SQLModel):
         logger.info(f'{self.__class__.__name__}: start...')
-        is_bandwidth_ok = True
+        is_bandwidth_ok = await self._check_bandwidth(inc_model)
         if not is_bandwidth_ok:
             logger.info(f'{self.__class__.__name__}: bandwidth checking is FAIL. Stop...')
             return None
-        inc_model.stage = self.stage
         inc_model.permit = True
-        result = await incident_service().update(inc=inc_model)
+        # the checkpoint before the port action, a chain which lost its incident stops here
+        if not await record_stage(inc_model, self.stage, fields=('permit',)):
+            logger.error(f'{self.__class__.__name__}: incident is handled by another run. Stop...')
+            return None
         logger.info(f'{self.__class__.__name__}: bandwidth checking is OK. Continue...')
         return await super().handle(inc_model)
 
+    @staticmethod
+    async def _check_bandwidth(inc_model: Incidents) -> bool:
+        # start_handler has prefetched the batch, this is a cache hit
+        bandwidths = await click_service().get_bandwidth([(inc_model.hostname, inc_model.interface)])
+        bandwidth = (bandwidths or {}).get((inc_model.hostname, inc_model.interface))
+        if bandwidth is None:
+            logger.info(f'Bandwidth of {inc_model.hostname} {inc_model.interface} is unknown')
+            return BANDWIDTH_LIMIT is None
+        logger.info(f'Bandwidth of {inc_model.hostname} {inc_model.interface}: p99 {bandwidth.load:.0f}, '
+                    f'siblings {len(bandwidth.siblings)}, projected {bandwidth.projected}')
+        if BANDWIDTH_LIMIT is None:
+            return True
+        # the traffic must fit into the remaining links to the peer
+        return bandwidth.projected is not None and bandwidth.projected <= BANDWIDTH_LIMIT
+
 
 class PortShutdownHandler(BaseHandler):
     stage = 'port_shutdown'
 
-    # dummy
     async def handle(self, inc_model: Incidents):
         time_from = int((inc_model.created_at - timedelta(minutes=25)).timestamp()*1000)
         time_to = min([int(datetime.now().timestamp()*1000), int((inc_model.created_at + timedelta(minutes=5)).timestamp()*1000)])
@@ -212,17 +182,24 @@ class PortShutdownHandler(BaseHandler):
                           f'Interface: {inc_model.interface}\n\n' \
                           f'<a href="{grafana_in_errors_link}">click me</a>'
             msg = self.title_msg(handler_msg)
-            mt_send_msg(chat_id=CHAT_ID, msg=msg, parse_mode="HTML")
+            # sent by the notifier task, a burst of alarms goes as one digest
+            notifier.notify(chat_id=CHAT_ID, text=msg, parse_mode="HTML",
+                            summary=f'{inc_model.hostname} {inc_model.interface} -- {inc_model.peer}: '
+                                    f'{inc_model.metric_type} {inc_model.metric_value}/sec, {inc_model.classname}')
             logger.info(f'{self.__class__.__name__}: start...')
 
-            device_type = 'juniper_junos'
+            device_type = NETWORK_DEVICE_TYPE
 
-            # turn ON when will be access to network
-            # result = await network_service(device_type=device_type).connect(host=inc_model.hostname)\
-            #     .set_interface(inc_model.interface, action="down")
+            if NETWORK_ENABLED:
+                # ports of the switch shut within the batch window share one commit
+                action_result = await port_batcher.submit(device_type, inc_model.hostname, inc_model.interface,
+                                                          action="down")
+                if not action_result.ok:
+                    logger.error(f'{self.__class__.__name__}: {inc_model.hostname} {inc_model.interface} '
+                                 f'is not shut down: {action_result.error}')
+                    return None
 
-            inc_model.stage = self.stage
-            result = await incident_service().update(inc=inc_model)
+            result = await record_stage(inc_model, self.stage)
             logger.info(f'{self.__class__.__name__}: {msg}. Continue...')
         return await super().handle(inc_model)
 
@@ -233,8 +210,7 @@ class CreateJiraIncidentHandler(BaseHandler):
     # dummy
     async def handle(self, inc_model: SQLModel):
         logger.info(f'{self.__class__.__name__}: start...')
-        inc_model.stage = self.stage
-        result = await incident_service().update(inc=inc_model)
+        result = await record_stage(inc_model, self.stage)
         logger.info(f'{self.__class__.__name__}: create new incident in Jira...')
         return await super().handle(inc_model)
 
@@ -281,24 +257,17 @@ class HandlerClasses(Enum):
     unclassified = None
 
 
-async def start_handler() -> None:
-    incident_items: List[Dict[str, Any]] = await incident_service().get_incidents_as_dict_with_filter(stage='initial',
-                                                                                                      permit=False,
-                                                                                                      running=False)
-    logger.info(f'Found total incidents: {len(incident_items)}')
-
-    if not incident_items:
-        logger.info(f'There is not a new incidents')
-        return None
-
-    for incident_item in incident_items:
-        logger.info(f'Found incident: {incident_item}')
-        logger.info(f'Found incident type: {type(incident_item)})')
+async def handle_incident(incident_item: Dict[str, Any]) -> None:
+    logger.info(f'Found incident: {incident_item}')
 
+    # stage transitions of the whole chain are written at checkpoints and on exit
+    async with stage_journal():
         incident_class = ClassifiedSingleHandler()
         incident = await incident_class.handle(incident_item)
 
         logger.info(f'Incident__in_start_handler: {incident}')
+        if incident is None:
+            return None
 
         match incident.classname:
             case HandlerClasses.peer_uplink.name:
@@ -317,6 +286,58 @@ async def start_handler() -> None:
                 logger.info(f'Unknown incident classname: {incident.classname}')
                 return None
 
+    if incident.stage != ClassifiedSingleHandler.stage:
+        # the chain went past the existence check, new events of the interface are suppressed for a while
+        await dedup_index.mark_closed(incident.hostname, incident.interface)
+
+
+def _handler_semaphore() -> asyncio.Semaphore:
+    global _semaphore
+    if _semaphore is None:
+        _semaphore = asyncio.Semaphore(HANDLER_CONCURRENCY)
+    return _semaphore
+
+
+async def _handle_incident_isolated(incident_item: Dict[str, Any], semaphore: asyncio.Semaphore) -> None:
+    hostname = incident_item.get('hostname')
+    # incidents of one switch run together, so their port actions can be coalesced by the batcher
+    async with semaphore:
+        try:
+            # the lease may have run out while the incident was waiting for a slot
+            if not await incident_service().renew_lease(incident_item, owner=WORKER_ID, lease_seconds=LEASE_SECONDS):
+                logger.info(f'Incident {hostname} {incident_item.get("interface")} is reclaimed by another run, skipped')
+                return None
+            await handle_incident(incident_item)
+        except Exception as err:
+            logger.exception(f'Incident {hostname} {incident_item.get("interface")} failed: {err}')
+
+
+async def start_handler(uuids: List = None) -> None:
+    """Claims and handles a batch of incidents, the given ones only with `uuids`."""
+    incident_items: List[Dict[str, Any]] = await incident_service().claim_incidents(owner=WORKER_ID,
+                                                                                    limit=CLAIM_BATCH,
+                                                                                    lease_seconds=LEASE_SECONDS,
+                                                                                    uuids=uuids)
+    logger.info(f'Found total incidents: {len(incident_items)}')
+
+    if not incident_items:
+        logger.info(f'There is not a new incidents')
+        return None
+
+    # roles come from the host index, resolved once per CMDB sync
+    hosts = await host_index.ensure_fresh()
+    for incident_item, (classname, role_h, role_p) in zip(incident_items, classify_many(incident_items, hosts)):
+        incident_item.update(classname=classname, role_h=role_h, role_p=role_p)
+
+    # one clickhouse query for the loads of the whole batch
+    try:
+        await click_service().get_bandwidth((item['hostname'], item['interface']) for item in incident_items)
+    except Exception as err:
+        logger.error(f'Bandwidth prefetch failed: {err}')
+
+    semaphore = _handler_semaphore()
+    await asyncio.gather(*(_handle_incident_isolated(incident_item, semaphore) for incident_item in incident_items))
+
 
 if __name__ == '__main__':
     asyncio.run(start_handler())
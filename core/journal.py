@@ -0,0 +1,88 @@
+__all__ = ("stage_journal",
+           "record_stage",
+           "flush_stages",
+           )
+
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from datetime import datetime
+from db.models import Incidents
+from services.services import incident_service
+from core.logger import logger
+from config import CONFIG
+
+
+# stages after which the journal is written at once, by default right before the port is shut down
+STAGE_CHECKPOINTS = set(CONFIG.get('handler', {}).get('checkpoints') or ('bandwidth_check',))
+
+_current_journal: ContextVar["StageJournal | None"] = ContextVar("stage_journal", default=None)
+
+
+class StageJournal:
+    """Stage transitions of one incident, collected during a chain run."""
+
+    def __init__(self):
+        self.incident: Incidents | None = None
+        self.fields = set()
+        self.stages = []
+
+    def record(self, incident: Incidents, stage: str, fields=()) -> None:
+        incident.stage = stage
+        self.incident = incident
+        self.fields.update(('stage', *fields))
+        self.stages.append((stage, datetime.now()))
+
+    def release(self) -> None:
+        # the chain is over, the incident must not be reclaimed by other workers
+        self.incident.lease_owner = None
+        self.incident.lease_expires_at = None
+        self.fields.update(('lease_owner', 'lease_expires_at'))
+
+    async def flush(self) -> bool:
+        if self.incident is None or not self.fields:
+            return True
+        fields, stages = self.fields, self.stages
+        self.fields, self.stages = set(), []
+        result = await incident_service().update_stages(self.incident, fields, stages)
+        logger.info(f'Stage journal of {self.incident.hostname} {self.incident.interface}: '
+                    f'{[stage for stage, _ in stages]} written')
+        return result
+
+
+@asynccontextmanager
+async def stage_journal():
+    """Collects stage transitions of the handlers running inside and writes them on exit.
+
+    The lease of the incident is released only when the chain has completed, after an
+    error it expires and the incident is claimed again.
+    """
+    journal = StageJournal()
+    token = _current_journal.set(journal)
+    completed = False
+    try:
+        yield journal
+        completed = True
+    finally:
+        _current_journal.reset(token)
+        if completed and journal.incident is not None:
+            journal.release()
+        await journal.flush()
+
+
+async def record_stage(incident: Incidents, stage: str, fields=()) -> bool:
+    """Records a stage transition, written immediately when no journal is active."""
+    journal = _current_journal.get()
+    if journal is None:
+        incident.stage = stage
+        return await incident_service().update_stages(incident, ('stage', *fields), [(stage, datetime.now())])
+    journal.record(incident, stage, fields)
+    if stage in STAGE_CHECKPOINTS:
+        return await journal.flush()
+    return True
+
+
+async def flush_stages() -> bool:
+    journal = _current_journal.get()
+    if journal is None:
+        return True
+    return await journal.flush()
@@ -0,0 +1,104 @@
+__all__ = ("IncidentListener",
+           )
+
+import asyncio
+import asyncpg
+
+from typing import Awaitable, Callable
+from config import CONFIG
+from core.logger import logger
+from db.service_repository import INCIDENTS_CHANNEL
+
+
+# notifications within this window are folded into one handler run
+NOTIFY_DEBOUNCE = CONFIG.get('handler', {}).get('notify_debounce') or 0.5
+RECONNECT_DELAY = 5
+
+
+def _listen_dsn() -> str:
+    # asyncpg takes a plain postgres dsn, not the sqlalchemy one
+    return CONFIG['db'].get('listen_url') or CONFIG['db']['url'].replace('+asyncpg', '')
+
+
+class IncidentListener:
+    """Runs `callback` right after new incidents are committed, via postgres LISTEN/NOTIFY.
+
+    A notification that arrives while the callback runs schedules exactly one more run.
+    The cron job stays as a safety net for notifications lost while reconnecting.
+    """
+
+    def __init__(self, callback: Callable[[], Awaitable], channel: str = INCIDENTS_CHANNEL,
+                 debounce: float = NOTIFY_DEBOUNCE, dsn: str = None):
+        self.callback = callback
+        self.channel = channel
+        self.debounce = debounce
+        self.dsn = dsn or _listen_dsn()
+        self._connection: asyncpg.Connection | None = None
+        self._wakeup: asyncio.Event | None = None
+        self._tasks = set()
+
+    async def start(self) -> None:
+        self._wakeup = asyncio.Event()
+        self._spawn(self._run())
+        try:
+            await self._connect()
+        except (OSError, asyncpg.PostgresError) as err:
+            # the worker starts anyway, cron handles incidents until the listener is back
+            logger.error(f'Listener connection to {self.channel} failed: {err}')
+            self._spawn(self._reconnect())
+
+    async def stop(self) -> None:
+        for task in list(self._tasks):
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        if self._connection is not None and not self._connection.is_closed():
+            self._connection.remove_termination_listener(self._on_terminate)
+            await self._connection.close()
+        self._connection = None
+
+    def _spawn(self, coro) -> None:
+        task = asyncio.create_task(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _connect(self) -> None:
+        connection = await asyncpg.connect(self.dsn)
+        try:
+            await connection.add_listener(self.channel, self._on_notify)
+        except Exception:
+            # a failed attempt leaves no connection behind, the next one opens its own
+            await connection.close()
+            raise
+        connection.add_termination_listener(self._on_terminate)
+        self._connection = connection
+        logger.info(f'Listening to {self.channel}')
+
+    def _on_notify(self, connection, pid, channel, payload) -> None:
+        logger.info(f'Notification {channel}: {payload}')
+        self._wakeup.set()
+
+    def _on_terminate(self, connection) -> None:
+        logger.error(f'Listener connection to {self.channel} is lost, reconnecting...')
+        self._spawn(self._reconnect())
+
+    async def _reconnect(self) -> None:
+        while True:
+            await asyncio.sleep(RECONNECT_DELAY)
+            try:
+                await self._connect()
+            except (OSError, asyncpg.PostgresError) as err:
+                logger.error(f'Listener reconnect failed: {err}')
+                continue
+            # incidents may have been committed while the connection was down
+            self._wakeup.set()
+            return None
+
+    async def _run(self) -> None:
+        while True:
+            await self._wakeup.wait()
+            await asyncio.sleep(self.debounce)
+            self._wakeup.clear()
+            try:
+                await self.callback()
+            except Exception as err:
+                logger.exception(f'Listener callback failed: {err}')
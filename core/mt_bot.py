@@ -20,8 +20,8 @@ def message_cb(bot, event):
 
 
 def send_msg(chat_id, msg, parse_mode=None):
-    bot = Bot(token=CONFIG["bot"]["token"], api_url_base=CONFIG["bot"]["url"])
-    bot.send_text(chat_id=chat_id, text=msg, parse_mode=parse_mode)
+    # the shared bot keeps its HTTP session alive between messages
+    return mybot.send_text(chat_id=chat_id, text=msg, parse_mode=parse_mode)
 
 
 def start_bot():
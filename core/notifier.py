@@ -0,0 +1,135 @@
+__all__ = ("NotificationDispatcher",
+           "notifier",
+           )
+
+import html
+import asyncio
+
+from collections import defaultdict
+from typing import Callable, Dict, List, NamedTuple
+from core.logger import logger
+from core.mt_bot import send_msg
+from config import CONFIG
+
+
+NOTIFIER_CONFIG = CONFIG.get('notifier', {})
+NOTIFIER_QUEUE_SIZE = NOTIFIER_CONFIG.get('queue_size') or 1000
+# alarms of a chat collected within the window, from digest_threshold on they go as one message
+NOTIFIER_DIGEST_WINDOW = NOTIFIER_CONFIG.get('digest_window') or 5
+NOTIFIER_DIGEST_THRESHOLD = NOTIFIER_CONFIG.get('digest_threshold') or 3
+NOTIFIER_DIGEST_LINES = NOTIFIER_CONFIG.get('digest_lines') or 50
+# seconds between two messages to one chat
+NOTIFIER_CHAT_INTERVAL = NOTIFIER_CONFIG.get('chat_interval') or 1
+NOTIFIER_RETRIES = NOTIFIER_CONFIG.get('retries', 3)
+NOTIFIER_BACKOFF = NOTIFIER_CONFIG.get('backoff') or 1
+
+
+class Notification(NamedTuple):
+    chat_id: str
+    text: str
+    parse_mode: str | None
+    # one line about the alarm, used in digests
+    summary: str
+
+
+class NotificationDispatcher:
+    """Sends messenger notifications from a background task.
+
+    Handlers enqueue and go on, the blocking bot call runs in a thread off the incident's
+    path. Messages to a chat are spaced by NOTIFIER_CHAT_INTERVAL and retried with backoff,
+    a burst of alarms within the digest window becomes one grouped message.
+    """
+
+    def __init__(self, send: Callable = send_msg):
+        self.send = send
+        self._queue: asyncio.Queue | None = None
+        self._worker: asyncio.Task | None = None
+        self._last_sent: Dict[str, float] = {}
+
+    def notify(self, chat_id, text: str, parse_mode: str = None, summary: str = None) -> bool:
+        """Enqueues the message and returns at once, False if the queue is full."""
+        self.start()
+        try:
+            self._queue.put_nowait(Notification(chat_id, text, parse_mode, summary or text.splitlines()[0]))
+        except asyncio.QueueFull:
+            logger.error(f'Notification queue is full, message to {chat_id} is dropped: {summary}')
+            return False
+        return True
+
+    def start(self) -> None:
+        if self._queue is None:
+            self._queue = asyncio.Queue(maxsize=NOTIFIER_QUEUE_SIZE)
+        if self._worker is None or self._worker.done():
+            self._worker = asyncio.create_task(self._run())
+
+    async def stop(self, timeout: float = 30) -> None:
+        if self._worker is None:
+            return None
+        # whatever is queued is still sent
+        try:
+            await asyncio.wait_for(self._queue.join(), timeout)
+        except asyncio.TimeoutError:
+            logger.error(f'Notifications are not sent: {self._queue.qsize()}')
+        self._worker.cancel()
+        self._worker = None
+
+    async def _run(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._queue.get()]
+            deadline = loop.time() + NOTIFIER_DIGEST_WINDOW
+            while (remaining := deadline - loop.time()) > 0:
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), remaining))
+                except asyncio.TimeoutError:
+                    break
+            try:
+                await self._dispatch(batch)
+            except Exception as err:
+                logger.exception(f'Notifications are lost: {err}')
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+
+    async def _dispatch(self, batch: List[Notification]) -> None:
+        chats = defaultdict(list)
+        for notification in batch:
+            chats[(notification.chat_id, notification.parse_mode)].append(notification)
+        for (chat_id, parse_mode), notifications in chats.items():
+            if len(notifications) < NOTIFIER_DIGEST_THRESHOLD:
+                for notification in notifications:
+                    await self._send(chat_id, notification.text, parse_mode)
+                continue
+            await self._send(chat_id, self._digest(notifications, parse_mode), parse_mode)
+
+    @staticmethod
+    def _digest(notifications: List[Notification], parse_mode: str | None) -> str:
+        escape = html.escape if parse_mode == "HTML" else str
+        lines = [escape(notification.summary) for notification in notifications[:NOTIFIER_DIGEST_LINES]]
+        if len(notifications) > NOTIFIER_DIGEST_LINES:
+            lines.append(f'... and {len(notifications) - NOTIFIER_DIGEST_LINES} more')
+        return f'Alarms detected: {len(notifications)}\n\n' + '\n'.join(lines)
+
+    async def _send(self, chat_id, text: str, parse_mode: str | None) -> None:
+        loop = asyncio.get_running_loop()
+        wait = self._last_sent.get(chat_id, 0) + NOTIFIER_CHAT_INTERVAL - loop.time()
+        if wait > 0:
+            await asyncio.sleep(wait)
+        for attempt in range(NOTIFIER_RETRIES + 1):
+            try:
+                response = await asyncio.to_thread(self.send, chat_id=chat_id, msg=text, parse_mode=parse_mode)
+                if getattr(response, 'ok', True):
+                    break
+                error = f'status {response.status_code}'
+            except Exception as err:
+                error = err
+            if attempt == NOTIFIER_RETRIES:
+                logger.error(f'Message to {chat_id} is not sent: {error}')
+                break
+            delay = NOTIFIER_BACKOFF * 2 ** attempt
+            logger.warning(f'Message to {chat_id} failed ({error}), retry {attempt + 1}/{NOTIFIER_RETRIES} in {delay}s')
+            await asyncio.sleep(delay)
+        self._last_sent[chat_id] = loop.time()
+
+
+notifier = NotificationDispatcher()
@@ -1,36 +1,126 @@
-from typing import Optional
+import time
 
-import redis
+from typing import Optional, Dict, Iterable, Tuple, Any
+from core.logger import logger
+from config import CONFIG
 
-from settings import REDIS_HOST, REDIS_PORT, REDIS_PASSWORD  # Import your Redis configuration
+try:
+    from redis import asyncio as aioredis
+except ImportError:  # the dedup index falls back to postgres
+    aioredis = None
+
+
+REDIS_CONFIG = CONFIG.get('redis', {})
+REDIS_HOST = REDIS_CONFIG.get('host') or 'localhost'
+REDIS_PORT = REDIS_CONFIG.get('port') or 6379
+REDIS_PASSWORD = REDIS_CONFIG.get('password')
+# not the arq database, the worker flushes that one on shutdown
+REDIS_DB = REDIS_CONFIG.get('db', 1)
+REDIS_TIMEOUT = REDIS_CONFIG.get('timeout') or 1
+# redis is not asked again for this long after an error
+REDIS_RETRY_AFTER = REDIS_CONFIG.get('retry_after') or 30
+# an interface with an incident is suppressed for DEDUP_ACTIVE_TTL, after the incident is
+# handled for DEDUP_WINDOW more, so a flapping interface does not open it again at once
+DEDUP_ACTIVE_TTL = REDIS_CONFIG.get('dedup_active_ttl') or 7 * 24 * 3600
+DEDUP_WINDOW = REDIS_CONFIG.get('dedup_window') or 1800
 
 
 class RedisClient:
     def __init__(self):
-        self._client: Optional[redis.Redis] = None
+        self._client: Optional["aioredis.Redis"] = None
+        self._down_until = 0.0
 
-    def get_connection(self):
-        """
-        Establishes a connection to the Redis server and returns the client object.
+    def get_connection(self) -> Optional["aioredis.Redis"]:
+        """Returns the shared async client, None if redis is not installed or recently failed.
 
-        Uses a private attribute to store the connection and avoid redundant connections.
+        The client keeps its own connection pool, connections are opened on first use.
         """
+        if aioredis is None or time.monotonic() < self._down_until:
+            return None
         if self._client is None:
-            self._client = redis.Redis(
+            self._client = aioredis.Redis(
                 host=REDIS_HOST,
                 port=REDIS_PORT,
                 password=REDIS_PASSWORD,
+                db=REDIS_DB,
+                socket_timeout=REDIS_TIMEOUT,
+                socket_connect_timeout=REDIS_TIMEOUT,
                 decode_responses=True  # Decode responses as strings for easier use
             )
         return self._client
 
+    def failed(self, err: Exception) -> None:
+        logger.warning(f'Redis is unavailable for {REDIS_RETRY_AFTER}s: {err}')
+        self._down_until = time.monotonic() + REDIS_RETRY_AFTER
+
+    async def close(self) -> None:
+        if self._client is not None:
+            await self._client.close()
+            self._client = None
+
 
 redis_client = RedisClient()  # Create a global instance of the client
 
-def get_redis():
+
+def get_redis() -> Optional["aioredis.Redis"]:
     """
     Returns the Redis client object.
 
     Uses the global instance of RedisClient to access the connection.
     """
     return redis_client.get_connection()
+
+
+class DedupIndex:
+    """(hostname, interface) keys of active and recently handled incidents.
+
+    The value of a key is the event_id of its incident, or 'closed' within the suppression
+    window after the incident is handled. Every method returns None or does nothing when
+    redis is unavailable, callers fall back to postgres then.
+    """
+    prefix = 'dedup:'
+    closed = 'closed'
+
+    def __init__(self, client: RedisClient, active_ttl: int = DEDUP_ACTIVE_TTL, window: int = DEDUP_WINDOW):
+        self.client = client
+        self.active_ttl = active_ttl
+        self.window = window
+
+    def _key(self, hostname: str, interface: str) -> str:
+        return f'{self.prefix}{hostname}|{interface}'
+
+    async def lookup(self, pairs: Iterable[Tuple[str, str]]) -> Dict[Tuple[str, str], str] | None:
+        """Returns the known keys among `pairs` with their values, in one round trip."""
+        redis = self.client.get_connection()
+        pairs = list(dict.fromkeys(pairs))
+        if redis is None or not pairs:
+            return None if redis is None else {}
+        try:
+            values = await redis.mget([self._key(*pair) for pair in pairs])
+        except Exception as err:
+            self.client.failed(err)
+            return None
+        return {pair: value for pair, value in zip(pairs, values) if value is not None}
+
+    async def mark_active(self, incidents: Iterable[Dict[str, Any]]) -> None:
+        await self._set(((incident['hostname'], incident['interface'], str(incident['event_id']))
+                         for incident in incidents), self.active_ttl)
+
+    async def mark_closed(self, hostname: str, interface: str) -> None:
+        await self._set(((hostname, interface, self.closed),), self.window)
+
+    async def _set(self, items: Iterable[Tuple[str, str, str]], ttl: int) -> None:
+        redis = self.client.get_connection()
+        items = list(items)
+        if redis is None or not items:
+            return None
+        try:
+            async with redis.pipeline(transaction=False) as pipe:
+                for hostname, interface, value in items:
+                    pipe.set(self._key(hostname, interface), value, ex=ttl)
+                await pipe.execute()
+        except Exception as err:
+            self.client.failed(err)
+
+
+dedup_index = DedupIndex(redis_client)
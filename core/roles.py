@@ -0,0 +1,60 @@
+__all__ = ("Role",
+           "EDGE_ROLES",
+           "CORE_ROLES",
+           "AGGREGATE_ROLES",
+           "BORDER_ROLES",
+           "CACHE_ROLES",
+           "ALL_ROLES",
+           "resolve_role",
+           )
+
+from enum import Enum
+from functools import lru_cache
+
+
+class Role(Enum):
+    core = 100
+    aggregate = 40
+    border = 30
+    spine = 20
+    edge = 10
+    leaf = 10
+    cache = 10
+    peer = 1
+    uplink = 1
+    office = 1
+    unclassified = 0
+
+    def __gt__(self, other):
+        return self.value > other.value
+
+    def __lt__(self, other):
+        return self.value < other.value
+
+    def __eq__(self, other):
+        return self.value == other.value
+
+    def __get__(self, item):
+        return self.value
+
+
+# CMDB network roles grouped by the part they play in a link
+EDGE_ROLES = ('edge', 'edge_minion', 'ddos_edge', 'edge_hadoop', 'edge_hosting', 'ext_edge')
+CORE_ROLES = ('core', 'ext_core', 'core_tarm_lan', 'core_p')
+AGGREGATE_ROLES = ('aggregate', 'aggregate_hosting')
+BORDER_ROLES = ('border',)
+CACHE_ROLES = ('cache',)
+ALL_ROLES = EDGE_ROLES + CORE_ROLES + AGGREGATE_ROLES + BORDER_ROLES
+
+
+@lru_cache(maxsize=4096)
+def resolve_role(roles: str | None) -> str | None:
+    """Effective role of a comma-joined NetworkRoles value: the highest ranked Role.
+
+    A single role is kept as it is. The number of distinct values is small, so every
+    combination is parsed once per process.
+    """
+    if not roles or ',' not in roles:
+        return roles
+    return Role(max(Role[role].value if role in ALL_ROLES and role in Role.__members__ else 0
+                    for role in roles.split(','))).name
@@ -1,58 +1,80 @@
 # Run worker: arq core.scheduler.WorkerSettings
 
-import aiohttp
+import asyncio
 import subprocess
 
-from httpx import AsyncClient
 from typing import Any
 from db.init_db import init_db
 from arq import cron
-from aiohttp.client_exceptions import ClientConnectorError
+from aiohttp import ClientError
 from .logger import logger
-from .handler import start_handler
+from .handler import start_handler, CLAIM_BATCH
+from .listener import IncidentListener
+from services.services import click_service, event_service, incident_service, collect_events
+from services.host_index import host_index
+from dependencies import click_pool
+from dependencies.http_interface import HTTPClient
+from core.redis_client import redis_client
+from network.sessions import device_sessions
+from .notifier import notifier
 from config.env import *
+from config import CONFIG
 from requests.status_codes import codes
 
 
+# 'http': call the API endpoints, 'inprocess': detect, create and handle incidents in the worker job
+PIPELINE_MODE = CONFIG.get('pipeline', {}).get('mode') or 'http'
+# run handlers as soon as incidents are created, not only by cron
+LISTEN_INCIDENTS = CONFIG.get('handler', {}).get('listen', True)
+
+backend_client = HTTPClient(base_url=API_URL)
+# handler runs started by cron jobs, they outlive the job which started them
+_handler_tasks = set()
+
+
 async def get_data_from_backend(url: str, log_msg: str, data=None, method="get") -> Any | None:
     logger.info(log_msg)
+    if method not in ("get", "post"):
+        logger.error(f"Invalid method: {method}")
+        return None
     try:
-        async with aiohttp.ClientSession() as session:
-            if method == "get":
-                async with session.get(url) as response:
-                    if response.status == codes.ok:
-                        data = await response.json()
-                        logger.info(f"GET request to {url} successful!: {data}")
-                        return data
-                    else:
-                        logger.error(f"GET request to {url} failed with status {response.status}")
-                        return None
-            elif method == "post":
-                async with session.post(url, json=data) as response:
-                    if response.status == codes.ok:
-                        data = await response.json()
-                        logger.info(f"POST request to {url} successful! {data}")
-                        return data
-                    else:
-                        logger.error(f"POST request to {url} failed with status {response.status}")
-                        return None
-            else:
-                logger.error(f"Invalid method: {method}")
-                return None
-    except ClientConnectorError as e:
+        status, response_data = await backend_client.request(method.upper(), url, json=data)
+    except (ClientError, asyncio.TimeoutError) as e:
         logger.error(f"API connection error: {e}")
         return None
+    if status == codes.ok:
+        logger.info(f"{method.upper()} request to {url} successful!: {response_data}")
+        return response_data
+    logger.error(f"{method.upper()} request to {url} failed with status {status}")
+    return None
 
 
 async def startup(ctx):
     logger.info(f"Scheduler: started ...")
     await init_db()
-    ctx['session'] = AsyncClient()
+    ctx['session'] = backend_client
     logger.info(f"Scheduler: init database ...")
+    await host_index.ensure_fresh()
+    notifier.start()
+    if LISTEN_INCIDENTS:
+        ctx['listener'] = IncidentListener(callback=start_handler)
+        await ctx['listener'].start()
 
 
 async def shutdown(ctx):
-    await ctx['session'].aclose()
+    # nothing starts new chains from here on, so the shared clients below are not reopened
+    if ctx.get('listener'):
+        await ctx['listener'].stop()
+    for task in list(_handler_tasks):
+        task.cancel()
+    await asyncio.gather(*_handler_tasks, return_exceptions=True)
+    # no new alarms from here on, the queued ones are still sent
+    await notifier.stop()
+    await HTTPClient.close_all()
+    await redis_client.close()
+    await device_sessions.close()
+    # handlers read the bandwidth through it in every pipeline mode
+    await click_pool.close()
     flush_redis_cache = subprocess.run(["redis-cli", "FLUSHDB"], capture_output=True, text=True)
     logger.info(f"Flush Redis cache: {flush_redis_cache.stdout}")
     logger.info(f"Scheduler: stopped ...")
@@ -62,10 +84,43 @@ async def scheduler_get_hosts(ctx):
     cmdb_url = f"{API_URL}/cmdb/"
     await get_data_from_backend(url=cmdb_url,
                                 log_msg="Fetching hosts from CMDB")
+    # the sync runs in the API process, the worker reloads its own copy
+    await host_index.refresh()
     logger.info(f"Scheduler: get hosts by cron...")
 
 
+async def run_pipeline() -> None:
+    events_result = await collect_events(click_service(), event_service())
+    logger.info(f"Events: {events_result}")
+    if not events_result.get('success'):
+        return None
+    incidents = await incident_service().fetch_incidents()
+    logger.info(f"Incidents created: {len(incidents)}")
+    # the new incidents go straight to their chains, which run apart from the job as they take
+    # longer than the cron timeout; a listener run which claims some of them first skips them here
+    uuids = [incident['uuid'] for incident in incidents]
+    for i in range(0, len(uuids), CLAIM_BATCH):
+        _spawn_handlers(uuids[i:i + CLAIM_BATCH])
+
+
+def _spawn_handlers(uuids: list = None) -> None:
+    task = asyncio.create_task(_run_handlers(uuids))
+    _handler_tasks.add(task)
+    task.add_done_callback(_handler_tasks.discard)
+
+
+async def _run_handlers(uuids: list = None) -> None:
+    try:
+        await start_handler(uuids)
+    except Exception as err:
+        logger.exception(f"Handlers failed: {err}")
+
+
 async def scheduler_incidents(ctx):
+    if PIPELINE_MODE == 'inprocess':
+        await run_pipeline()
+        logger.info(f"Scheduler: pipeline run by cron ...")
+        return None
     events_url = f"{API_URL}/events/inerrors/"
     events_result = await get_data_from_backend(url=events_url,
                                                 log_msg="Fetching events from ClickHouse")
@@ -79,7 +134,8 @@ async def scheduler_incidents(ctx):
 
 
 async def scheduler_handlers(ctx):
-    await start_handler()
+    # a claimed batch outlives the cron timeout, a chain cancelled past its checkpoint would hold its lease
+    _spawn_handlers()
     logger.info(f"Scheduler: worker run by cron ...")
 
 
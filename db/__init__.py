@@ -3,4 +3,6 @@ from .models import CMDBNetworkHostBackup
 from .models import Incidents
 from .models import Events
 from .models import EventsUnknown
+from .models import DetectorState
+from .models import IncidentStageHistory
 
@@ -3,7 +3,7 @@ from typing import Optional
 from datetime import datetime
 import uuid as uuid_pkg
 from sqlalchemy.dialects import postgresql
-from sqlalchemy import UniqueConstraint
+from sqlalchemy import UniqueConstraint, Column
 
 
 # type: "InErrors"
@@ -40,6 +40,7 @@ class CMDBNetworkHost(SQLModel, table=True):
     OrgUnitName: str = Field(default=None, nullable=False)
     DataCenterLocation: str = Field(default=None, nullable=False)
     DataCenterLocationId: int = Field(default=None, nullable=False)
+    content_hash: Optional[str] = Field(default=None, nullable=True)  # sha256 of the CMDB attributes
 
 
 class CMDBNetworkHostBackup(SQLModel, table=True):
@@ -60,6 +61,7 @@ class CMDBNetworkHostBackup(SQLModel, table=True):
     OrgUnitName: str = Field(default=None, nullable=False)
     DataCenterLocation: str = Field(default=None, nullable=False)
     DataCenterLocationId: int = Field(default=None, nullable=False)
+    content_hash: Optional[str] = Field(default=None, nullable=True)
     # DataCenterLocationName: str = Field(default=None, nullable=False)
 
 
@@ -99,6 +101,14 @@ class EventsUnknown(SQLModel, table=True):
     created_at: datetime = Field(default_factory=datetime.now, nullable=False)
 
 
+class DetectorState(SQLModel, table=True):
+    # last processed Timestamp and running counters of a clickhouse detector
+    name: str = Field(primary_key=True, nullable=False)
+    watermark: int = Field(default=0, nullable=False)
+    counters: dict = Field(default_factory=dict, sa_column=Column(postgresql.JSONB, nullable=False))
+    updated_at: datetime = Field(default_factory=datetime.now, nullable=False)
+
+
 class Incidents(SQLModel, table=True):
     uuid: uuid_pkg.UUID = Field(default_factory=uuid_pkg.uuid4,
                                 primary_key=True,
@@ -131,6 +141,9 @@ class Incidents(SQLModel, table=True):
     stage: str = Field(default="initial", nullable=False)
     permit: bool = Field(default=True, nullable=False)
     running: bool = Field(default=False, nullable=False)  # stop/start
+    version: int = Field(default=0, nullable=False)  # bumped by every update
+    lease_owner: Optional[str] = Field(default=None, nullable=True)  # worker which handles the incident
+    lease_expires_at: Optional[datetime] = Field(default=None, nullable=True)
     
 
     __table_args__ = (
@@ -142,3 +155,11 @@ class Incidents(SQLModel, table=True):
 
     def __str__(self):
         return f"Hostname: {self.hostname}, Port: {self.interface}, Link_Type: {self.link_type}, Classname: {self.classname}, Stage: {self.stage}"
+
+
+class IncidentStageHistory(SQLModel, table=True):
+    # audit trail of the stages an incident went through
+    id: Optional[int] = Field(default=None, primary_key=True)
+    incident_id: uuid_pkg.UUID = Field(nullable=False, index=True)
+    stage: str = Field(default=None, nullable=False)
+    created_at: datetime = Field(default_factory=datetime.now, nullable=False)
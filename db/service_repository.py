@@ -1,26 +1,106 @@
-from sqlmodel import text
+import json
+import hashlib
+import uuid as uuid_pkg
+
+from sqlmodel import text, select, update, delete
+from sqlalchemy import tuple_, and_, or_, func
+from sqlalchemy.dialects.postgresql import insert
 from db.sql_repository import SQLModelRepository
-from db.models import CMDBNetworkHost, CMDBNetworkHostBackup, Events, EventsUnknown
+from db.models import CMDBNetworkHost, CMDBNetworkHostBackup, Events, EventsUnknown, DetectorState, IncidentStageHistory
 from db.session import async_session
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Iterable, Tuple
+from datetime import datetime, timedelta
 from db.models import Incidents
-from pydantic_core import ValidationError
 from core.logger import logger
 
 
+# postgres NOTIFY channel, a payload is the number of created incidents
+INCIDENTS_CHANNEL = 'incidents_created'
+# stages written before the alarm and the port shutdown, an expired lease is reclaimed only
+# in them; from bandwidth_check on the chain may have acted and is not rerun blindly
+RECLAIMABLE_STAGES = ('initial', 'classification', 'existence_check')
+
+
 class HostsRepository(SQLModelRepository):
     model = CMDBNetworkHost
     model_backup = CMDBNetworkHostBackup
     events = Events
+    # CMDB attributes of a host, content_hash is computed from them
+    host_fields = ('HostName', 'NodeMember', 'Status', 'Interfaces', 'HardwareModelName', 'NetworkType',
+                   'NetworkRoles', 'OrgUnitName', 'DataCenterLocation', 'DataCenterLocationId')
+    chunk_size = 1000
+
+    @classmethod
+    def content_hash(cls, host: CMDBNetworkHost) -> str:
+        content = json.dumps([getattr(host, field) for field in cls.host_fields], default=str)
+        return hashlib.sha256(content.encode()).hexdigest()
+
+    async def sync(self, hosts: List[CMDBNetworkHost], full: bool = True) -> Dict[str, int]:
+        """Brings the hosts table in line with CMDB, writing only what has changed.
+
+        New and changed hosts (by content hash) are upserted in bulk, with `full` the
+        hosts missing from CMDB are deleted. An unchanged CMDB costs a single SELECT.
+        """
+        rows = {}
+        for host in hosts:
+            row = host.model_dump(include={'uuid', *self.host_fields})
+            row['content_hash'] = self.content_hash(host)
+            # like the unique constraint did, the first host of a name wins
+            rows.setdefault(row['HostName'], row)
+        changed, vanished = [], []
+        async with async_session() as session:
+            async with session.begin():
+                existing = dict((await session.execute(select(self.model.HostName, self.model.content_hash))).all())
+                changed = [row for name, row in rows.items() if existing.get(name) != row['content_hash']]
+                if full:
+                    vanished = [name for name in existing if name not in rows]
+
+                for i in range(0, len(changed), self.chunk_size):
+                    statement = insert(self.model).values(changed[i:i + self.chunk_size])
+                    statement = statement.on_conflict_do_update(
+                        index_elements=['HostName'],
+                        set_={field: statement.excluded[field] for field in (*self.host_fields, 'content_hash')
+                              if field != 'HostName'})
+                    await session.execute(statement)
+                if vanished:
+                    await session.execute(delete(self.model).where(self.model.HostName.in_(vanished)))
+        result = {'total': len(rows), 'changed': len(changed), 'deleted': len(vanished)}
+        logger.info(f'CMDB sync: {result}')
+        return result
 
     async def backup(self):
-        truncate_backup_sql_query = f"TRUNCATE TABLE {self.model_backup.__name__.lower()} CASCADE;"
-        fill_backup_sql_query = f"INSERT INTO {self.model_backup.__name__.lower()} SELECT * FROM {self.model.__name__.lower()};"
+        """Applies the differences between the hosts table and its backup to the backup.
+
+        The backup is referenced by the events FK, so it is never truncated: changed rows are
+        upserted, vanished hosts are deleted together with their events.
+        """
+        backup_table = self.model_backup.__name__.lower()
+        table = self.model.__name__.lower()
+        columns = ', '.join(f'"{column}"' for column in ('uuid', *self.host_fields, 'content_hash'))
+        updates = ', '.join(f'"{column}" = EXCLUDED."{column}"' for column in ('uuid', *self.host_fields, 'content_hash')
+                            if column != 'HostName')
+        upsert_backup_sql_query = f"""
+            INSERT INTO {backup_table} ({columns}) SELECT {columns} FROM {table}
+            ON CONFLICT ("HostName") DO UPDATE SET {updates}
+            WHERE {backup_table}.content_hash IS DISTINCT FROM EXCLUDED.content_hash;"""
+        vanished_hosts = f"""SELECT b."HostName" FROM {backup_table} b
+            WHERE NOT EXISTS (SELECT 1 FROM {table} h WHERE h."HostName" = b."HostName")"""
+        delete_events_sql_query = f"DELETE FROM {self.events.__name__.lower()} WHERE hostname IN ({vanished_hosts});"
+        delete_backup_sql_query = f'DELETE FROM {backup_table} WHERE "HostName" IN ({vanished_hosts});'
         async with async_session() as session:
             async with session.begin():
-                await session.execute(text(truncate_backup_sql_query))
-                await session.execute(text(fill_backup_sql_query))
-                await session.commit()
+                await session.execute(text(upsert_backup_sql_query))
+                await session.execute(text(delete_events_sql_query))
+                await session.execute(text(delete_backup_sql_query))
+
+    async def index_rows(self) -> List[Tuple]:
+        # the backup is what events and incidents are enriched from
+        statement = select(self.model_backup.HostName,
+                           self.model_backup.Status,
+                           self.model_backup.NetworkRoles,
+                           self.model_backup.HardwareModelName)
+        async with async_session() as session:
+            return list((await session.execute(statement)).all())
 
 
 class HostsBackupRepository(SQLModelRepository):
@@ -30,59 +110,295 @@ class HostsBackupRepository(SQLModelRepository):
 class EventsRepository(SQLModelRepository):
     model = Events
     model_unknown = EventsUnknown
+    # rows per INSERT, keeps bind parameters below the postgres limit of 32767
+    chunk_size = 1000
+
+    async def add_many(self, events: List[Events], check_incidents: bool = True) -> List[Events]:
+        """Stores a batch of events in one transaction and returns the inserted ones.
+
+        Events of interfaces which already have an incident are skipped, unless the caller
+        has checked that already (`check_incidents=False`). Events of hosts
+        unknown to CMDB would violate the hostname FK, they go to eventsunknown instead,
+        once per hostname/interface.
+        """
+        if not events:
+            return []
+        pairs = {(event.hostname, event.interface) for event in events}
+        hostnames = {event.hostname for event in events}
+        added = []
+        async with async_session() as session:
+            async with session.begin():
+                with_incident = set()
+                if check_incidents:
+                    for chunk in self._chunks(pairs):
+                        statement = select(Incidents.hostname, Incidents.interface) \
+                            .where(tuple_(Incidents.hostname, Incidents.interface).in_(chunk))
+                        with_incident.update(tuple(row) for row in (await session.execute(statement)).all())
+                known_hosts = set()
+                for chunk in self._chunks(hostnames):
+                    statement = select(CMDBNetworkHostBackup.HostName).where(CMDBNetworkHostBackup.HostName.in_(chunk))
+                    known_hosts.update((await session.execute(statement)).scalars().all())
+
+                new_events = [event for event in events if (event.hostname, event.interface) not in with_incident]
+                known = [event for event in new_events if event.hostname in known_hosts]
+                unknown = [event for event in new_events if event.hostname not in known_hosts]
+
+                for i in range(0, len(known), self.chunk_size):
+                    chunk = known[i:i + self.chunk_size]
+                    statement = insert(self.model) \
+                        .values([event.model_dump() for event in chunk]) \
+                        .on_conflict_do_nothing() \
+                        .returning(self.model.uuid)
+                    inserted = set((await session.execute(statement)).scalars().all())
+                    added.extend(event for event in chunk if event.uuid in inserted)
+
+                if unknown:
+                    unknown_pairs = {(event.hostname, event.interface) for event in unknown}
+                    seen = set()
+                    for chunk in self._chunks(unknown_pairs):
+                        statement = select(self.model_unknown.hostname, self.model_unknown.interface) \
+                            .where(tuple_(self.model_unknown.hostname, self.model_unknown.interface).in_(chunk))
+                        seen.update(tuple(row) for row in (await session.execute(statement)).all())
+                    unknown_rows = []
+                    for event in unknown:
+                        if (event.hostname, event.interface) in seen:
+                            continue
+                        seen.add((event.hostname, event.interface))
+                        event_data = event.model_dump(exclude={"uuid"})
+                        unknown_rows.append(self.model_unknown.model_validate(event_data).model_dump())
+                    logger.info(f"Events of unknown hosts: {len(unknown_rows)}")
+                    for i in range(0, len(unknown_rows), self.chunk_size):
+                        await session.execute(insert(self.model_unknown).values(unknown_rows[i:i + self.chunk_size]))
+        return added
+
+    def _chunks(self, values: Iterable) -> Iterable[list]:
+        # IN lists are bound parameters too, they are kept below the limit like the inserts
+        values = list(values)
+        for i in range(0, len(values), self.chunk_size):
+            yield values[i:i + self.chunk_size]
+
+
+class DetectorStateRepository(SQLModelRepository):
+    model = DetectorState
+
+    async def load(self, name: str) -> DetectorState | None:
+        async with async_session() as session:
+            return await session.get(self.model, name)
+
+    async def save(self, state: DetectorState, version: datetime | None) -> bool:
+        """Stores the state unless it was saved by someone else after it was loaded.
+
+        `version` is the updated_at the state was loaded with, None for a state which was
+        not stored yet. Returns False if the stored row has moved on.
+        """
+        values = state.model_dump()
+        if version is None:
+            statement = insert(self.model).values(values).on_conflict_do_nothing(index_elements=['name'])
+        else:
+            statement = update(self.model) \
+                .where(self.model.name == state.name, self.model.updated_at == version) \
+                .values(values)
+        async with async_session() as session:
+            async with session.begin():
+                result = await session.execute(statement)
+        return bool(result.rowcount)
 
 
 class IncidentsRepository(SQLModelRepository):
     model = Incidents
+    chunk_size = 1000
 
-    async def get_incidents(self) -> List[Dict[str, Any]]:
-        incidents_list = []
+    async def get_incidents(self, hosts=None) -> List[Dict[str, Any]]:
+        """Creates incidents from the enriched events and returns the new ones.
+
+        Events are enriched from the in-memory host index when `hosts` is given, otherwise
+        by joining the CMDB backup in one statement. Events which make it into the candidate
+        set are consumed (deleted) in the same transaction, whether they produced a new
+        incident or hit an existing one.
+        """
         async with async_session() as session:
             async with session.begin():
-                incidents = await session.execute(text("""
-                SELECT DISTINCT ON (e.uuid, e.hostname, e.interface)
-                    e.uuid as event_id,
-                    e.hostname,                
-                    e.interface,
-                    e.link_type,
-                    e.peer,
-                    h1."Status" as status_h,
-                    COALESCE(h2."Status",'') as status_p,
-                    h1."NetworkRoles" as role_h,
-                    COALESCE(h2."NetworkRoles",'') as role_p,  
-                    h1."HardwareModelName" as model_h,
-                    h2."HardwareModelName" as model_p,
-                    'undefined' as classname,          
-                    e.type as metric_type,
-                    e.value as metric_value,
-                    'undefined' AS assigned_to,
-                    e.created_at,
-                    'Critical' AS priority,  -- CASE WHEN e.value > 100 THEN 'Critical' ELSE 'Low' END AS priority, 
-                    'initial' AS stage,
-                    FALSE AS permit,
-                    FALSE AS running                                              
-                FROM CMDBNetworkHostBackup h1
-                INNER JOIN Events e ON e.hostname = h1."HostName"
-                LEFT JOIN CMDBNetworkHostBackup h2 ON e.peer = h2."HostName"
-                WHERE h1."Status" = 'Production' AND (h2."Status" = 'Production' OR h2."Status" IS NULL)
-                --   AND (h2."HostName" IS NULL OR h2."HostName" IS NOT NULL)
-                ORDER BY e.hostname, e.interface    
-                -- ORDER BY e.interface
-                """))
-                # print(f'>>> __INCIDENTS__: {incidents.one_or_none()}')
-                for inc_model in incidents.all():
-                    print(f'>>> INC MODEL IS: {type(inc_model)}  {inc_model}')
-                    try:
-                        inc_model_valid = Incidents.model_validate(inc_model)
-                    except ValidationError as e:
-                        print(f'>>> ValidationError')
-                        logger.error(f'>>> ERROR: {e}')
-                        continue
-                    inc_dict = inc_model_valid.model_dump(exclude={"uuid"})
-                    incidents_list.append(inc_dict)
-                    await self.add_one(inc_model_valid)
+                if hosts is not None:
+                    incidents_list = await self._incidents_from_index(session, hosts)
+                else:
+                    incidents_list = await self._incidents_from_backup(session)
+                if incidents_list:
+                    # delivered to the listening workers on commit
+                    await session.execute(text("SELECT pg_notify(:channel, :payload)"),
+                                          {"channel": INCIDENTS_CHANNEL, "payload": str(len(incidents_list))})
+        logger.info(f'>>> New incidents: {len(incidents_list)}')
         return incidents_list
 
+    async def _incidents_from_index(self, session, hosts) -> List[Dict[str, Any]]:
+        statement = select(Events) \
+            .where(Events.link_type.is_not(None), Events.peer.is_not(None)) \
+            .order_by(Events.hostname, Events.interface, Events.created_at) \
+            .with_for_update(skip_locked=True)
+        events = (await session.execute(statement)).scalars().all()
+        rows = []
+        for event in events:
+            host, peer = hosts.get(event.hostname), hosts.get(event.peer)
+            # the same conditions as the join in _incidents_from_backup
+            if host is None or host.status != 'Production' or host.roles is None:
+                continue
+            if peer is not None and peer.status != 'Production':
+                continue
+            rows.append(dict(uuid=uuid_pkg.uuid4(), event_id=event.uuid, hostname=event.hostname,
+                             interface=event.interface, link_type=event.link_type, peer=event.peer,
+                             status_h=host.status, status_p=peer.status if peer else '',
+                             role_h=host.roles, role_p=(peer.roles or '') if peer else '',
+                             model_h=host.model, model_p=peer.model if peer else None,
+                             classname='undefined', metric_type=event.type, metric_value=event.value,
+                             assigned_to='undefined', created_at=event.created_at, priority='Critical',
+                             stage='initial', permit=False, running=False, version=0))
+        if not rows:
+            return []
+
+        incidents_list = []
+        for i in range(0, len(rows), self.chunk_size):
+            # the earliest event of an interface wins, the others hit the conflict
+            statement = insert(self.model) \
+                .values(rows[i:i + self.chunk_size]) \
+                .on_conflict_do_nothing(index_elements=['hostname', 'interface']) \
+                .returning(*self.model.__table__.columns)
+            incidents = await session.execute(statement)
+            incidents_list.extend(dict(row) for row in incidents.mappings().all())
+        consumed = [row['event_id'] for row in rows]
+        for i in range(0, len(consumed), self.chunk_size):
+            await session.execute(delete(Events).where(Events.uuid.in_(consumed[i:i + self.chunk_size])))
+        return incidents_list
+
+    async def _incidents_from_backup(self, session) -> List[Dict[str, Any]]:
+        incidents = await session.execute(text("""
+        WITH candidates AS (
+            SELECT
+                e.uuid as event_id,
+                e.hostname,
+                e.interface,
+                e.link_type,
+                e.peer,
+                h1."Status" as status_h,
+                COALESCE(h2."Status",'') as status_p,
+                h1."NetworkRoles" as role_h,
+                COALESCE(h2."NetworkRoles",'') as role_p,
+                h1."HardwareModelName" as model_h,
+                h2."HardwareModelName" as model_p,
+                'undefined' as classname,
+                e.type as metric_type,
+                e.value as metric_value,
+                'undefined' AS assigned_to,
+                e.created_at,
+                'Critical' AS priority,  -- CASE WHEN e.value > 100 THEN 'Critical' ELSE 'Low' END AS priority,
+                'initial' AS stage,
+                FALSE AS permit,
+                FALSE AS running,
+                0 AS version
+            FROM CMDBNetworkHostBackup h1
+            INNER JOIN Events e ON e.hostname = h1."HostName"
+            LEFT JOIN CMDBNetworkHostBackup h2 ON e.peer = h2."HostName"
+            WHERE h1."Status" = 'Production' AND (h2."Status" = 'Production' OR h2."Status" IS NULL)
+              -- incidents columns are NOT NULL, such events are left in place
+              AND e.link_type IS NOT NULL AND e.peer IS NOT NULL AND h1."NetworkRoles" IS NOT NULL
+        ),
+        consumed AS (
+            DELETE FROM Events WHERE uuid IN (SELECT event_id FROM candidates)
+        )
+        INSERT INTO Incidents (uuid, event_id, hostname, interface, link_type, peer,
+                               status_h, status_p, role_h, role_p, model_h, model_p,
+                               classname, metric_type, metric_value, assigned_to, created_at,
+                               priority, stage, permit, running, version)
+        SELECT gen_random_uuid(), event_id, hostname, interface, link_type, peer,
+               status_h, status_p, role_h, role_p, model_h, model_p,
+               classname, metric_type, metric_value, assigned_to, created_at,
+               priority, stage, permit, running, version
+        FROM candidates
+        -- the earliest event of an interface wins, the others hit the conflict
+        ORDER BY hostname, interface, created_at
+        ON CONFLICT (hostname, interface) DO NOTHING
+        RETURNING *
+        """))
+        return [dict(row) for row in incidents.mappings().all()]
+
+    async def exists_other(self, inc: Incidents, window: int) -> bool:
+        """Another incident of the interface exists, or one went past the existence check
+        within the last `window` seconds, the incident itself included (a rerun)."""
+        other = select(self.model.uuid) \
+            .where(self.model.hostname == inc.hostname,
+                   self.model.interface == inc.interface,
+                   self.model.uuid != inc.uuid)
+        handled = select(IncidentStageHistory.id) \
+            .join(self.model, self.model.uuid == IncidentStageHistory.incident_id) \
+            .where(self.model.hostname == inc.hostname,
+                   self.model.interface == inc.interface,
+                   IncidentStageHistory.stage.not_in(RECLAIMABLE_STAGES),
+                   IncidentStageHistory.created_at > datetime.now() - timedelta(seconds=window))
+        statement = select(or_(other.exists(), handled.exists()))
+        async with async_session() as session:
+            return bool((await session.execute(statement)).scalar())
+
+    async def claim(self, owner: str, limit: int, lease_seconds: int, uuids: Iterable = None) -> List[Dict[str, Any]]:
+        """Leases up to `limit` incidents to the worker `owner` and returns them.
+
+        New incidents and incidents whose lease has expired (their worker crashed) before
+        the irreversible part of the chain are claimable. Rows locked by another worker are skipped, so several workers can drain
+        the backlog at once without waiting for each other or handling an incident twice.
+        """
+        claimable = or_(and_(self.model.lease_owner.is_(None),
+                             self.model.stage == 'initial',
+                             self.model.permit.is_(False),
+                             self.model.running.is_(False)),
+                        and_(self.model.lease_expires_at < func.now(),
+                             self.model.stage.in_(RECLAIMABLE_STAGES)))
+        candidates = select(self.model.uuid).where(claimable)
+        if uuids is not None:
+            candidates = candidates.where(self.model.uuid.in_(list(uuids)))
+        candidates = candidates.order_by(self.model.created_at).limit(limit).with_for_update(skip_locked=True)
+        statement = update(self.model) \
+            .where(self.model.uuid.in_(candidates)) \
+            .values(lease_owner=owner,
+                    lease_expires_at=func.now() + timedelta(seconds=lease_seconds),
+                    version=self.model.version + 1) \
+            .returning(*self.model.__table__.columns)
+        async with async_session() as session:
+            async with session.begin():
+                result = await session.execute(statement)
+                incidents = [dict(row) for row in result.mappings().all()]
+        logger.info(f'>>> Claimed incidents by {owner}: {len(incidents)}')
+        return incidents
+
+    async def renew_lease(self, inc: Dict[str, Any], owner: str, lease_seconds: int) -> bool:
+        """Extends the lease of a claimed incident, False if it is not held at inc['version'] any more."""
+        statement = update(self.model) \
+            .where(self.model.uuid == inc['uuid'],
+                   self.model.version == inc['version'],
+                   self.model.lease_owner == owner) \
+            .values(lease_expires_at=func.now() + timedelta(seconds=lease_seconds),
+                    version=self.model.version + 1) \
+            .returning(self.model.version, self.model.lease_expires_at)
+        async with async_session() as session:
+            async with session.begin():
+                row = (await session.execute(statement)).first()
+        if row is None:
+            return False
+        inc.update(version=row.version, lease_expires_at=row.lease_expires_at)
+        return True
+
+    async def update_stages(self, inc: Incidents, fields: Iterable[str], stages: List[Tuple[str, datetime]]) -> bool:
+        """Writes the changed columns and appends the stage history in one transaction.
+
+        The row is written only at the version the chain holds, an incident reclaimed by
+        another run in the meantime is left alone and False is returned.
+        """
+        async with async_session() as session:
+            async with session.begin():
+                result = await session.execute(self._update_statement(inc, fields, check_version=True))
+                if result.rowcount and stages:
+                    await session.execute(insert(IncidentStageHistory).values([
+                        {"incident_id": inc.uuid, "stage": stage, "created_at": created_at}
+                        for stage, created_at in stages
+                    ]))
+        return self._after_update(inc, result.rowcount)
+
     async def push_cache(self) -> List[Dict[str, Any]]:
         raise NotImplementedError()
 
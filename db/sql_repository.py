@@ -1,10 +1,10 @@
 from abc import ABC, abstractmethod
-from sqlmodel import SQLModel, select  # Session
+from sqlmodel import SQLModel, select, update  # Session
 from db.session import async_session
-from typing import Union, Dict, List, Any
+from typing import Union, Dict, List, Any, Iterable
 from sqlalchemy.engine.result import ScalarResult
 from copy import deepcopy
-from db.models import Events, Incidents
+from db.models import Events
 from core.logger import logger
 from sqlalchemy.exc import IntegrityError
 
@@ -169,26 +169,37 @@ class SQLModelRepository(AbstractRepository):
                 print('\n>>>>>>>>>>>>>>>>> run POP <<<<<<<<<<<<<<<<<<<<')
         return data
 
-    async def update(self, inc: SQLModel) -> bool:
-        print(">>> INC:", inc)
-        print(">>> TYPE_INC:", type(inc))
+    async def update(self, inc: SQLModel, fields: Iterable[str] = None, check_version: bool = False) -> bool:
+        """Writes columns of an existing item with a single UPDATE ... WHERE uuid = ...
+
+        Args:
+            inc: The item (SQLModel instance), its uuid selects the row.
+            fields: Columns to write. If None, all columns except uuid are written.
+            check_version: Optimistic concurrency for models with a version column:
+                           the row is updated only if its version still equals inc.version.
+        Returns:
+            False if no row was updated: the item is missing or was changed concurrently.
+        """
         async with async_session() as session:
             async with session.begin():
-                statement = select(self.model).with_for_update(read=True, nowait=True).where(self.model.uuid == inc.uuid).limit(1)
-                inc_exists = await session.execute(statement)
-                if inc_exists:
-                    print(">>> inc_exists:", inc_exists)
-                    item = inc_exists.one_or_none()
-                    print(f">>> item: {type(item)} {item}")
-                    inc_model = Incidents.sqlmodel_update(Incidents(), obj=inc)
-                    await session.delete(item[0])
-                    session.add(inc_model)
-                    await session.commit()
-                    print(f'\n>>>>>>>>>>>>>>>>> run INC_UPDATE <<<<<<<<<<<<<<<<<<<<')
-                else:
-                    session.add(inc)
-                    await session.commit()
-                    print(f'\n>>>>>>>>>>>>>>>>> run INC_INSERT <<<<<<<<<<<<<<<<<<<<')
+                result = await session.execute(self._update_statement(inc, fields, check_version))
+        return self._after_update(inc, result.rowcount)
+
+    def _update_statement(self, inc: SQLModel, fields: Iterable[str] = None, check_version: bool = False):
+        values = inc.model_dump(include=set(fields) if fields else None, exclude={"uuid", "version"})
+        statement = update(self.model).where(self.model.uuid == inc.uuid).values(**values)
+        if "version" in self.model.model_fields:
+            statement = statement.values(version=self.model.version + 1)
+            if check_version:
+                statement = statement.where(self.model.version == inc.version)
+        return statement
+
+    def _after_update(self, inc: SQLModel, rowcount: int) -> bool:
+        if not rowcount:
+            logger.error(f"Item {inc.uuid} is not updated: not found or changed concurrently")
+            return False
+        if "version" in self.model.model_fields:
+            inc.version += 1
         return True
 
     async def delete_all(self):
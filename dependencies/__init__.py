@@ -1,8 +1,10 @@
 import aiohttp
 from dependencies.cmdb import CMDBHttpClient
+from dependencies.click_pool import ClickHousePool
 from config import CONFIG
 
 __all__ = ('cmdb_client',
+           'click_pool',
            )
 
 CMDB_API_URL = CONFIG['cmdb']['url']
@@ -15,3 +17,9 @@ cmdb_client = CMDBHttpClient(base_url=CMDB_API_URL,
                                  "verify_ssl": False,
                                  "timeout": aiohttp.ClientTimeout(total=10)},
                              )
+
+# one pool of ClickHouse connections per process, shared by all requests
+click_pool = ClickHousePool(url=CONFIG['clickhouse']['host'],
+                            port=CONFIG['clickhouse']['port'],
+                            size=CONFIG['clickhouse'].get('pool_size') or 4,
+                            timeout=CONFIG['clickhouse'].get('query_timeout') or 60)
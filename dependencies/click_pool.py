@@ -0,0 +1,105 @@
+import asyncio
+import uuid
+
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Iterator
+from clickhouse_driver import Client as ClickHouseClient
+from core.logger import logger
+
+
+__all__ = ('ClickHousePool',
+           )
+
+
+class ClickHousePool:
+    """Bounded pool of reusable ClickHouse clients for the asyncio code.
+
+    clickhouse_driver is synchronous, so every query runs in the pool's own threads
+    and never blocks the event loop. A client serves one query at a time and goes back
+    to the pool only when its thread is done with it. On timeout or cancellation the
+    query is killed on the server, `max_execution_time` is a second line of defense.
+    """
+
+    def __init__(self, url, port=9000, size=4, timeout=60, connect_timeout=30):
+        self.url = url
+        self.port = port
+        self.size = size
+        self.timeout = timeout
+        self.connect_timeout = connect_timeout
+        self._clients: asyncio.LifoQueue | None = None
+        self._executor = ThreadPoolExecutor(max_workers=size, thread_name_prefix='clickhouse')
+
+    def _new_client(self) -> ClickHouseClient:
+        # the connection is opened on the first query and kept alive afterwards
+        return ClickHouseClient(self.url,
+                                port=self.port,
+                                connect_timeout=self.connect_timeout,
+                                settings={'max_execution_time': self.timeout})
+
+    def _get_clients(self) -> asyncio.LifoQueue:
+        if self._clients is None:
+            self._clients = asyncio.LifoQueue(maxsize=self.size)
+            for _ in range(self.size):
+                self._clients.put_nowait(self._new_client())
+        return self._clients
+
+    async def run(self, query: str, consume: Callable[[Iterator[tuple]], Any] = list,
+                  settings: dict = None, timeout: float = None) -> Any:
+        """Runs the query on a pooled client and returns consume(rows).
+
+        Rows are read block by block with execute_iter and `consume` runs in the same
+        worker thread, so a streaming consumer keeps memory bounded without touching the loop.
+        """
+        clients = self._get_clients()
+        client = await clients.get()
+        query_id = str(uuid.uuid4())
+
+        def execute():
+            finished = False
+
+            def rows():
+                nonlocal finished
+                yield from client.execute_iter(query, settings=settings, query_id=query_id)
+                finished = True
+
+            try:
+                return consume(rows())
+            finally:
+                if not finished:
+                    # unread packets of the stream would break the next query on this client,
+                    # it reconnects on its next use instead
+                    client.disconnect()
+
+        loop = asyncio.get_running_loop()
+        future = loop.run_in_executor(self._executor, execute)
+        future.add_done_callback(lambda _: clients.put_nowait(client))
+        try:
+            return await asyncio.wait_for(asyncio.shield(future), timeout or self.timeout)
+        except (asyncio.TimeoutError, asyncio.CancelledError):
+            logger.error(f'ClickHouse query {query_id} is cancelled: {query}')
+            await self._kill_query(query_id)
+            raise
+
+    async def execute(self, query: str, settings: dict = None, timeout: float = None) -> list:
+        return await self.run(query, settings=settings, timeout=timeout)
+
+    async def _kill_query(self, query_id: str) -> None:
+        def kill():
+            # a separate short connection, all pooled clients may be busy
+            client = self._new_client()
+            try:
+                client.execute(f"KILL QUERY WHERE query_id = '{query_id}' ASYNC")
+            finally:
+                client.disconnect()
+
+        try:
+            await asyncio.to_thread(kill)
+        except Exception as err:
+            logger.error(f'Cannot kill ClickHouse query {query_id}: {err}')
+
+    async def close(self) -> None:
+        if self._clients is not None:
+            while not self._clients.empty():
+                self._clients.get_nowait().disconnect()
+            self._clients = None
+        self._executor.shutdown(wait=False, cancel_futures=True)
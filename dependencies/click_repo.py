@@ -3,16 +3,18 @@
 
 import re
 import sys
-import hashlib
+import asyncio
 # import random
 from collections import defaultdict
+from functools import lru_cache
 
-from typing import Iterable, Any, List
+from typing import Iterable, Any, List, NamedTuple
 from config import CONFIG
 from datetime import datetime, timedelta
-from clickhouse_driver import Client as ClickHouseClient
 from clickhouse_driver import errors as ClickHouseErrors
-from db.models import Events
+from dependencies.click_pool import ClickHousePool
+from db.models import Events, DetectorState
+from db.service_repository import DetectorStateRepository
 from core.logger import logger
 from clickhouse_driver.errors import SocketTimeoutError
 
@@ -28,15 +30,119 @@ MAX_INERRORS_THRESHOLD_LIMIT = CONFIG['clickhouse']['metric']['inerrors']['thres
 MAX_INERRORS_COUNTS = CONFIG['clickhouse']['metric']['inerrors']['threshold_counter_limit']
 TIME_INTERVAL = CONFIG['clickhouse']['metric']['inerrors']['time_interval_minutes']
 CLICK_DELAY = CONFIG['clickhouse']['metric']['inerrors'].get('delay_minutes') or 0
+# rows per block for streaming reads, peak memory depends on it and not on TIME_INTERVAL
+CLICK_BLOCK_SIZE = CONFIG['clickhouse'].get('max_block_size') or 10000
+# distinct metric paths kept parsed, a few thousand repeat in every sample
+CLICK_PATH_CACHE_SIZE = CONFIG['clickhouse'].get('path_cache_size') or 65536
+# 'stream': count runs in python row by row, 'aggregate': count runs inside the clickhouse query
+CLICK_QUERY_MODE = CONFIG['clickhouse']['metric']['inerrors'].get('query_mode') or 'stream'
+# read only rows newer than the persisted watermark and carry run counters between polls
+CLICK_INCREMENTAL = CONFIG['clickhouse']['metric']['inerrors'].get('incremental', True)
+# incremental polls read only rows at least this old, graphite samples arrive late and a row
+# behind the watermark is never read again
+CLICK_INGEST_MARGIN = CONFIG['clickhouse']['metric']['inerrors'].get('ingest_margin_seconds') or 120
+INERRORS_STATE_NAME = 'inerrors'
+
+BANDWIDTH_CONFIG = CONFIG['clickhouse']['metric'].get('bandwidth') or {}
+# octets samples of the last BANDWIDTH_WINDOW minutes give the p99 load of an interface
+BANDWIDTH_WINDOW = BANDWIDTH_CONFIG.get('window_minutes') or 60
+BANDWIDTH_QUANTILE = BANDWIDTH_CONFIG.get('quantile') or 0.99
+# loads of a host are reused for this long, the handlers of a batch hit the cache
+BANDWIDTH_CACHE_TTL = BANDWIDTH_CONFIG.get('cache_ttl') or 120
+
+INERRORS_PATH_FILTER = "like(Path, '%InErrors%') and (like(Path, '%-I-%') or like(Path, '%-P-%') or like(Path, '%-U-%'))"
+
+_METRIC_PATH_PATTERN = re.compile(r'^(.*?)\.interfaces\.(.*?)\.(.*?)\.(.*)$')
+_EXCLUDE_INTERFACES_PATTERN = re.compile('|'.join(f'(?:{pattern})' for pattern in EXCLUDE_INTERFACES), re.IGNORECASE)
+_LINK_TYPE_PATTERN = re.compile(r"-([A-Z])-")
+# the same parts of a path as _METRIC_PATH_PATTERN, written for re2 in the aggregate query
+_AGGREGATE_KEY_PATTERN = '^(.*?[.]interfaces[.][^.]+)[.]'
+_AGGREGATE_DESCRIPTION_PATTERN = '^.*?[.]interfaces[.][^.]+[.]([^.]*)[.]'
+
+
+class MetricPath(NamedTuple):
+    hostname: str
+    interface: str
+    description: str
+    link_type: str | None
+    peer: str
+    excluded: bool
+    key: str
+
+
+class InterfaceLoad(NamedTuple):
+    interface: str
+    peer: str
+    link_type: str | None
+    in_p99: float
+    out_p99: float
+
+    @property
+    def load(self) -> float:
+        return max(self.in_p99, self.out_p99)
+
+
+class Bandwidth(NamedTuple):
+    hostname: str
+    interface: str
+    load: float
+    # other links of the host to the same peer, they take the traffic over on shutdown
+    siblings: tuple
+    # load of every sibling once the interface is down, None without siblings
+    projected: float | None
+
+
+# hostname -> (expires at, {interface: InterfaceLoad})
+_bandwidth_cache: dict = {}
 
 
 def _exclude_interfaces(interface: str) -> bool:
-    return any(re.compile(f"{pattern}", re.IGNORECASE).match(interface) for pattern in EXCLUDE_INTERFACES)
+    return bool(_EXCLUDE_INTERFACES_PATTERN.match(interface))
+
+
+@lru_cache(maxsize=CLICK_PATH_CACHE_SIZE)
+def classify_metric_path(path: str) -> MetricPath | None:
+    """Parses a graphite path like '<hostname>.interfaces.<interface>.<description>.<type>'.
+
+    The result is cached by the raw path and shared between rows, so parsing cost
+    depends on the number of distinct interfaces only. `excluded` is set for paths
+    which never produce events: service interfaces, no description or no link type flag.
+    """
+    match = _METRIC_PATH_PATTERN.match(path)
+    if not match:
+        return None
+    hostname, interface, description, event_type = match.groups()
+    if not all((hostname, interface, description, event_type)):
+        return None
+
+    hostname = sys.intern(hostname)
+    interface = sys.intern(interface)
+    key = sys.intern(f"{hostname}:{interface}")
+    link_type = None
+    peer = ""
+    excluded = _exclude_interfaces(interface) or description == 'None'
+    if not excluded:
+        link_types = _LINK_TYPE_PATTERN.findall(description)
+        if link_types:
+            link_type = link_types[0].strip()
+            new_description = _LINK_TYPE_PATTERN.sub(r"", description).lstrip('_')
+            peer = sys.intern(new_description.split('_')[0])
+        else:
+            excluded = True
+    return MetricPath(hostname=hostname,
+                      interface=interface,
+                      description=description,
+                      link_type=link_type,
+                      peer=peer,
+                      excluded=excluded,
+                      key=key)
 
 
 class ClickRepository:
-    def __init__(self, url, port=9000):
-        self.client = ClickHouseClient(url, port=port, connect_timeout=30)
+    def __init__(self, url=None, port=9000, pool: ClickHousePool = None):
+        self.pool = pool or ClickHousePool(url, port=port)
+        # detector state of the last poll and the updated_at it was loaded with, see commit_state
+        self._pending_state: tuple | None = None
 
     @staticmethod
     def convert_speed_to_human_readable(speed_in_bps):
@@ -48,143 +154,274 @@ class ClickRepository:
         return f"{speed_in_bps:.2f} {units[unit_index]}"
 
     async def get_events_inoutoctets(self, hostname, interface, dev=False) -> str | None:
-        global time_start, date_start
-        date_start = datetime.today().strftime('%Y-%m-%d')
-        query = f"SELECT quantile(0.99)(Value) FROM default.distributed_net_graphite PREWHERE Date = '2024-05-27' where like(Path, '%Octets%') and like(Path, '%{hostname}.interfaces.{interface}.%')"
-        print(f'QUERY: {query}')
-        time_start_time = datetime.fromtimestamp(int(1715469502))
-        time_end_time = datetime.fromtimestamp(int(1715469872))
-        metrics: List = self._get_clickhouse_metrics(query)
-        if not metrics:
+        bandwidth = (await self.get_bandwidth([(hostname, interface)]) or {}).get((hostname, interface))
+        if bandwidth is None:
             logger.error(f'InOut metrics not found')
             return None
-        in_out_octets_quantile_metric = self.convert_speed_to_human_readable(metrics[0][0])
-        return in_out_octets_quantile_metric
+        return self.convert_speed_to_human_readable(bandwidth.load)
+
+    async def get_bandwidth(self, pairs: Iterable[tuple]) -> dict | None:
+        """p99 In/Out load of the (hostname, interface) pairs and of their sibling links.
+
+        All interfaces of the hosts missing from the cache are read with one query, so a
+        batch of incidents costs one query and the handlers of the batch hit the cache.
+        Returns None if clickhouse can't be queried.
+        """
+        pairs = list(dict.fromkeys(pairs))
+        now = datetime.now().timestamp()
+        hostnames = sorted({hostname for hostname, _ in pairs
+                            if _bandwidth_cache.get(hostname, (0, None))[0] <= now})
+        if hostnames:
+            loads = await self._query_host_loads(hostnames)
+            if loads is None:
+                return None
+            for hostname in hostnames:
+                _bandwidth_cache[hostname] = (now + BANDWIDTH_CACHE_TTL, loads.get(hostname, {}))
+            for hostname, (expires_at, _) in list(_bandwidth_cache.items()):
+                if expires_at <= now:
+                    del _bandwidth_cache[hostname]
+
+        result = {}
+        for hostname, interface in pairs:
+            interfaces = _bandwidth_cache.get(hostname, (0, {}))[1]
+            current = interfaces.get(interface)
+            if current is None:
+                continue
+            siblings = tuple(item for name, item in interfaces.items()
+                             if name != interface and item.peer == current.peer and item.link_type == current.link_type)
+            projected = (current.load + sum(item.load for item in siblings)) / len(siblings) if siblings else None
+            result[(hostname, interface)] = Bandwidth(hostname, interface, current.load, siblings, projected)
+        return result
+
+    async def _query_host_loads(self, hostnames: List[str]) -> dict | None:
+        time_end = int(datetime.now().timestamp())
+        time_start = time_end - BANDWIDTH_WINDOW * 60
+        date_start = datetime.fromtimestamp(time_start).strftime('%Y-%m-%d')
+        # prefix matches on Path use the primary key, unlike like('%...%')
+        hosts_filter = ' or '.join(f"startsWith(Path, '{hostname}.interfaces.')" for hostname in hostnames)
+        query = f"SELECT Path, quantile({BANDWIDTH_QUANTILE})(Value) FROM default.distributed_net_graphite " \
+                f"PREWHERE Date >= '{date_start}' and Timestamp > {time_start} " \
+                f"where ({hosts_filter}) and like(Path, '%Octets%') GROUP BY Path"
+        logger.info(f'QUERY: {query}')
+        metrics = await self._get_clickhouse_metrics(query)
+        if metrics is False:
+            return None
 
-    async def get_events_inerrors(self, dev=False) -> list[Events] | None:
+        octets = defaultdict(lambda: [0.0, 0.0])
+        paths = {}
+        for metric_path, metric_value in metrics:
+            metric = classify_metric_path(metric_path)
+            if not metric:
+                continue
+            direction = 0 if metric_path.rsplit('.', 1)[-1].startswith(('In', 'HCIn')) else 1
+            octets[(metric.hostname, metric.interface)][direction] = metric_value or 0.0
+            paths[(metric.hostname, metric.interface)] = metric
+
+        loads = defaultdict(dict)
+        for (hostname, interface), (in_p99, out_p99) in octets.items():
+            metric = paths[(hostname, interface)]
+            loads[hostname][interface] = InterfaceLoad(interface, metric.peer, metric.link_type, in_p99, out_p99)
+        return loads
+
+    async def get_events_inerrors(self, dev=False, mode=None) -> list[Events] | None:
+        mode = mode or CLICK_QUERY_MODE
+        state = None
+        version = None
+        self._pending_state = None
+        inerrors_count = defaultdict(int)
         # dev
         #
         # 1.
         if not CONFIG['debug']['mode']:
             date_now = datetime.now()
-            date_start = datetime.today().strftime('%Y-%m-%d')
             time_start = int((date_now - timedelta(minutes=TIME_INTERVAL, seconds=10)).timestamp()) - CLICK_DELAY * 60
             time_end = int(date_now.timestamp()) - CLICK_DELAY * 60
+            if CLICK_INCREMENTAL and mode != 'aggregate':
+                time_end = min(time_end, int(date_now.timestamp()) - CLICK_INGEST_MARGIN)
+                state = await DetectorStateRepository().load(INERRORS_STATE_NAME)
+                if state is not None:
+                    version = state.updated_at
+                else:
+                    state = DetectorState(name=INERRORS_STATE_NAME)
+                # continue from the last processed row, unless the worker was away longer than a window
+                if time_start <= state.watermark < time_end:
+                    time_start = state.watermark
+                    inerrors_count.update(state.counters)
+            # the window may cross midnight, so both Date partitions are read
+            date_start = datetime.fromtimestamp(time_start).strftime('%Y-%m-%d')
+            date_end = datetime.fromtimestamp(time_end).strftime('%Y-%m-%d')
+            date_filter = f"Date >= '{date_start}' and Date <= '{date_end}'"
         else:
             date_start = CONFIG['debug']['date_start']
             time_start = CONFIG['debug']['time_start']
             time_end = CONFIG['debug']['time_end']
+            date_filter = f"Date = '{date_start}'"
         #
         # dev end
-        query = f"SELECT * FROM default.distributed_net_graphite PREWHERE Date = '{date_start}' and Timestamp > {time_start} and Timestamp < {time_end} where like(Path, '%InErrors%') and (like(Path, '%-I-%') or like(Path, '%-P-%') or like(Path, '%-U-%')) ORDER BY Timestamp"
+        if mode == 'aggregate':
+            query = self._inerrors_aggregate_query(date_filter, time_start, time_end)
+        else:
+            query = f"SELECT Path, Value, Timestamp FROM default.distributed_net_graphite PREWHERE {date_filter} and Timestamp > {time_start} and Timestamp < {time_end} where {INERRORS_PATH_FILTER} ORDER BY Timestamp"
         t1 = datetime.fromtimestamp(time_start).strftime("%Y-%m-%d %H:%M:%S")
         t2 = datetime.fromtimestamp(time_end).strftime("%Y-%m-%d %H:%M:%S")
         logger.info(f'QUERY: {query}\nfrom {t1} to {t2}')
+
+        def consume(rows):
+            # rows are handled block by block as they arrive, the result set is never materialized
+            events = list()
+            watermark = time_start
+            for metric_path, metric_value, metric_timestamp in rows:
+                if mode == 'aggregate':
+                    event = self._check_inerrors_candidate(metric_path, metric_value, metric_timestamp)
+                else:
+                    event = self._check_inerrors_metric(metric_path, metric_value, metric_timestamp, inerrors_count)
+                    watermark = max(watermark, metric_timestamp)
+                if event:
+                    events.append(event)
+            return events, watermark
+
         try:
-            metrics: List = self._get_clickhouse_metrics(query)
+            events, watermark = await self.pool.run(query, consume, settings={'max_block_size': CLICK_BLOCK_SIZE})
         except SocketTimeoutError:
             logger.error(f'SocketTimeoutError: {query}')
             return None
-        if not metrics:
-            return []
+        except ClickHouseErrors.NetworkError as err:
+            logger.error(f'ERROR: clickhouse connection failed: {err}')
+            return None
+        except asyncio.TimeoutError:
+            logger.error(f'ERROR: clickhouse query timeout: {query}')
+            return None
 
-        events = list()
-        inerrors_count = defaultdict(int)
-        for metric in metrics:
-            metric_path = metric[0]
-            metric_dict = self._parse_metric(metric_path)
-            if not metric_dict:
-                continue
-            try:
-                metric_value = round(metric[1])
-            except (OverflowError, ValueError):
-                metric_value = 0
-            metric_timestamp = metric[4]
-            if metric_value < MAX_INERRORS_THRESHOLD_LIMIT:
-                inerrors_count[metric_dict['hash']] = 0
-                continue
-            if _exclude_interfaces(metric_dict['interface']):
-                continue
-            # TODO: check down interface
-            #
-            if metric_dict['description'] == 'None':
-                continue
+        if state:
+            state.watermark = watermark
+            # only running series are kept, a missing key means a zero counter
+            state.counters = {key: count for key, count in inerrors_count.items() if count}
+            # saved only once the events are stored, otherwise they would be lost for good
+            self._pending_state = (state, version)
 
-            peer = None
-            flag_pattern = re.compile(r"-([A-Z])-")
-            link_types = flag_pattern.findall(metric_dict['description'])
-            if link_types:
-                link_type = link_types[0].strip()
-            else:
-                continue
-            new_description = flag_pattern.sub(r"", metric_dict['description']).lstrip('_')
-            description_split = new_description.split('_')
-            if description_split:
-                peer = description_split[0]
-            inerrors_count[metric_dict['hash']] += 1
-            msg = f"Hostname: {metric_dict['hostname']}, " \
-                  f"Interface: {metric_dict['interface']}, " \
-                  f"Value: {metric_value}, " \
-                  f"Count: {inerrors_count[metric_dict['hash']]} " \
-                  f"Date: {datetime.fromtimestamp(metric_timestamp)}"
-            logger.info('!!!  ' + msg)
-            if inerrors_count[metric_dict['hash']] == MAX_INERRORS_COUNTS:
-                event = Events(type="InErrors",
-                               hostname=metric_dict['hostname'],
-                               interface=metric_dict['interface'],
-                               description=metric_dict['description'],
-                               link_type=link_type or "",
-                               peer=peer or "",
-                               value=str(metric_value),
-                               created_at=datetime.fromtimestamp(metric_timestamp))
-                events.append(event)
-                logger.info('>>>  ' + msg)
         if dev:
             print('!!! DEV !!!')
             print(events)
             print('!!! DEV END !!!')
         return events
 
-    def _get_clickhouse_metrics(self, query: str):
+    async def commit_state(self) -> bool:
+        """Saves the detector state of the last poll, call it after its events are stored.
+
+        Returns False if another run (the worker or the manual endpoint) has saved the state
+        since this poll loaded it, its watermark is kept then.
+        """
+        if self._pending_state is None:
+            return True
+        state, version = self._pending_state
+        self._pending_state = None
+        state.updated_at = datetime.now()
+        saved = await DetectorStateRepository().save(state, version=version)
+        if not saved:
+            logger.warning(f'Detector state {state.name} was advanced by another run, this poll is not saved')
+        return saved
+
+    @staticmethod
+    def _check_inerrors_metric(metric_path, metric_value, metric_timestamp, inerrors_count) -> Events | None:
+        metric = classify_metric_path(metric_path)
+        if not metric:
+            return None
         try:
-            response = self.client.execute(query)
-        except ClickHouseErrors.NetworkError as err:
-            text = f'ERROR: clickhouse connection failed: {err}'
-            print(text)
-            return False
-        except KeyboardInterrupt:
-            print('\nterminate script process by Ctrl-C\n')
-            sys.exit(1)
-        return response
+            metric_value = round(metric_value)
+        except (OverflowError, ValueError):
+            metric_value = 0
+        if metric_value < MAX_INERRORS_THRESHOLD_LIMIT:
+            inerrors_count[metric.key] = 0
+            return None
+        # TODO: check down interface
+        #
+        if metric.excluded:
+            return None
+
+        inerrors_count[metric.key] += 1
+        msg = f"Hostname: {metric.hostname}, " \
+              f"Interface: {metric.interface}, " \
+              f"Value: {metric_value}, " \
+              f"Count: {inerrors_count[metric.key]} " \
+              f"Date: {datetime.fromtimestamp(metric_timestamp)}"
+        logger.info('!!!  ' + msg)
+        if inerrors_count[metric.key] != MAX_INERRORS_COUNTS:
+            return None
+        logger.info('>>>  ' + msg)
+        return ClickRepository._inerrors_event(metric, metric_value, metric_timestamp)
 
     @staticmethod
-    def _parse_metric(metric):
-        pattern = r'^(.*?)\.interfaces\.(.*?)\.(.*?)\.(.*)$'
-        match = re.match(pattern, metric)
+    def _check_inerrors_candidate(metric_path, metric_value, metric_timestamp) -> Events | None:
+        # the run length has already been checked by the aggregate query
+        metric = classify_metric_path(metric_path)
+        if not metric or metric.excluded:
+            return None
+        metric_value = round(metric_value)
+        msg = f"Hostname: {metric.hostname}, " \
+              f"Interface: {metric.interface}, " \
+              f"Value: {metric_value}, " \
+              f"Count: {MAX_INERRORS_COUNTS} " \
+              f"Date: {datetime.fromtimestamp(metric_timestamp)}"
+        logger.info('>>>  ' + msg)
+        return ClickRepository._inerrors_event(metric, metric_value, metric_timestamp)
 
-        if match:
-            hostname = match.group(1)  
-            interface = match.group(2) 
-            description = match.group(3)
-            event_type = match.group(4) 
+    @staticmethod
+    def _inerrors_event(metric: MetricPath, metric_value: int, metric_timestamp) -> Events:
+        return Events(type="InErrors",
+                      hostname=metric.hostname,
+                      interface=metric.interface,
+                      description=metric.description,
+                      link_type=metric.link_type or "",
+                      peer=metric.peer or "",
+                      value=str(metric_value),
+                      created_at=datetime.fromtimestamp(metric_timestamp))
 
-            if not all((bool(hostname), bool(interface), bool(description), bool(event_type))):
-                return None
+    @staticmethod
+    def _inerrors_aggregate_query(date_filter, time_start, time_end) -> str:
+        """Query which counts consecutive over-threshold samples per interface on the server side.
 
-            return {
-                'hostname': hostname,
-                'interface': interface,
-                'description': description,
-                'type': event_type,
-                'hash':  hashlib.sha256(f"{hostname}:{interface})".encode()).hexdigest()
-            }
-        else:
-            # print(f"Unknown metric: {metric}")
-            return None
+        Samples of a <hostname>.interfaces.<interface> prefix are sorted by Timestamp, so
+        a description change within the window does not split the run, like the python
+        loop keyed on hostname:interface. A sample adds 1 to the run, resets it
+        (arrayCumSumNonNegative clamps the big negative step to 0) or, with an excluded
+        description, leaves it as is. A row is returned for every sample which brings the
+        run to MAX_INERRORS_COUNTS, with the path, value and timestamp of that sample.
+        Non-finite values are counted as 0.
+        """
+        description = f"extract(x.3, '{_AGGREGATE_DESCRIPTION_PATTERN}')"
+        return f"""
+        SELECT hit.3 AS Path, hit.1 AS Value, hit.2 AS Timestamp
+        FROM (
+            SELECT extract(Path, '{_AGGREGATE_KEY_PATTERN}') AS Interface,
+                   arraySort(x -> x.2, groupArray((Value, Timestamp, Path))) AS samples,
+                   arrayMap(x -> multiIf(NOT isFinite(x.1) OR round(x.1) < {MAX_INERRORS_THRESHOLD_LIMIT}, -1000000000,
+                                         {description} = 'None' OR NOT match({description}, '{_LINK_TYPE_PATTERN.pattern}'), 0,
+                                         1), samples) AS steps,
+                   arrayCumSumNonNegative(steps) AS runs
+            FROM default.distributed_net_graphite
+            PREWHERE {date_filter} and Timestamp > {time_start} and Timestamp < {time_end}
+            WHERE {INERRORS_PATH_FILTER}
+            GROUP BY Interface
+            HAVING Interface != '' AND has(runs, {MAX_INERRORS_COUNTS})
+        )
+        ARRAY JOIN arrayFilter((x, run, step) -> run = {MAX_INERRORS_COUNTS} AND step = 1, samples, runs, steps) AS hit
+        ORDER BY Timestamp
+        """
+
+    async def _get_clickhouse_metrics(self, query: str):
+        try:
+            response = await self.pool.execute(query)
+        except ClickHouseErrors.NetworkError as err:
+            logger.error(f'ERROR: clickhouse connection failed: {err}')
+            return False
+        except asyncio.TimeoutError:
+            logger.error(f'ERROR: clickhouse query timeout: {query}')
+            return False
+        return response
 
 
 if __name__ == '__main__':
     click_repo = ClickRepository(url=CLICK_URL, port=CLICK_PORT)
-    click_repo.get_events_inerrors(dev=True)
+    asyncio.run(click_repo.get_events_inerrors(dev=True))
     
 
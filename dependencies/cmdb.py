@@ -1,80 +1,158 @@
-import aiohttp
+import asyncio
 
-from typing import List, Dict
+from typing import List, Dict, Tuple
+from datetime import datetime, timedelta, timezone
+from config import CONFIG
 from db.models import CMDBNetworkHost
 from .http_interface import HTTPClient
 
 
+# hosts per request and requests in flight while paging through CMDB
+CMDB_PAGE_SIZE = CONFIG['cmdb'].get('page_size') or 500
+CMDB_PAGE_CONCURRENCY = CONFIG['cmdb'].get('page_concurrency') or 4
+# CMDB attribute with the modification time of a host, enables incremental fetch if set
+CMDB_MODIFIED_FIELD = CONFIG['cmdb'].get('modified_field')
+# a full fetch is still done periodically, incremental ones can't see deleted hosts
+CMDB_FULL_SYNC_HOURS = CONFIG['cmdb'].get('full_sync_hours') or 24
+
+
 class CMDBHttpClient(HTTPClient):
     def __init__(self, base_url: str, params: dict = None,):
         super().__init__(base_url, params)
+        self.last_sync: datetime | None = None
+        self.last_full_sync: datetime | None = None
+
+    async def _get_cmdb_items(self, query: str) -> Tuple[List[Dict], str | None] | None:
+        """(hosts of the page, @odata.nextLink or None), None if the page can't be read.
 
-    async def _get_cmdb_items(self, query: str) -> List[Dict]:
+        Every page is retried on its own by HTTPClient.
+        """
         try:
-            async with aiohttp.ClientSession() as session:
-                async with session.get(query, **self.params) as response:
-                    if response.status == 200:
-                        return await response.json()
-                    else:
-                        print(f"CMDB request failed with status {response.status}.")
-                        return []
+            status, data = await self.request('GET', query)
+            if status == 200:
+                if isinstance(data, dict):
+                    return data.get('value', []), data.get('@odata.nextLink')
+                return data, None
+            else:
+                print(f"CMDB request failed with status {status}.")
+                return None
         except Exception as error:
             print(f'CMDB connection error [{self._get_cmdb_items.__name__}]. {error}')
-            return []
+            return None
 
-    async def get_cmdb_model_objects(self, dev=False) -> list[CMDBNetworkHost] | None:
+    async def get_cmdb_model_objects(self, dev=False, since: datetime = None) -> list[CMDBNetworkHost] | None:
+        """Fetches hosts page by page ($top/$skip), CMDB_PAGE_CONCURRENCY pages at once.
+
+        With `since` only hosts modified after it are requested. Pages are decoded and
+        converted one wave at a time, the raw JSON of the whole inventory is never held.
+        """
         from config.config import CMDB_FILTER
+        cmdb_filter = CMDB_FILTER
+        if since and CMDB_MODIFIED_FIELD:
+            cmdb_filter = f"({CMDB_FILTER}) and {CMDB_MODIFIED_FIELD} gt {since.strftime('%Y-%m-%dT%H:%M:%SZ')}"
         query = f"{self.base_url}hosts?$" \
                 f"select=HostName, NodeMember, Status, Interfaces, HardwareModelName, OrgUnitName, NetworkType, NetworkRoles, DataCenterLocation, DataCenterLocationId&$" \
                 f"expand=Interfaces($select = Ip)&$" \
-                f"filter={CMDB_FILTER}"
+                f"filter={cmdb_filter}&$" \
+                f"orderby=HostName"
         print(query)
-        cmdb_hosts: List[Dict] = await self._get_cmdb_items(query=query)
 
-        if not cmdb_hosts:
-            raise Exception('CMDB unreachable')
+        page_size = CMDB_PAGE_SIZE
+        while True:
+            hosts_list, total_hosts, first_item, server_page_size = await self._get_pages(query, page_size)
+            if server_page_size is None:
+                break
+            if server_page_size >= page_size:
+                # pages change while being read, a full sync must not act on such a list
+                raise Exception('CMDB paging is inconsistent')
+            # the server caps $top below ours, $skip must step by its page or hosts are missed
+            print(f'CMDB returns pages of {server_page_size} hosts, fetching again with that page size')
+            page_size = server_page_size
 
-        hosts_list = []
-        for item in cmdb_hosts:
-            new_item = {key: value for key, value in item.items() if key not in ['Interfaces']}
-            new_item['Interfaces'] = ','.join(ip_dict.get('Ip') for ip_dict in item['Interfaces'] if
-                                              ip_dict['Ip'] is not None)
-            if isinstance(item['NetworkRoles'], list):
-                new_item['NetworkRoles'] = ','.join(item['NetworkRoles'])
-            if not new_item['NetworkRoles']:
-                continue
-            if '_' in new_item['HostName']:
-                new_item['HostName'] = new_item['HostName'].split('_')[0]
-
-            host = CMDBNetworkHost(HostName=new_item['HostName'],
-                                   NodeMember=new_item['NodeMember'],
-                                   Status=new_item['Status'],
-                                   Interfaces=new_item.get('Interfaces'),
-                                   HardwareModelName=new_item['HardwareModelName'],
-                                   OrgUnitName=new_item['OrgUnitName'],
-                                   NetworkType=new_item['NetworkType'],
-                                   NetworkRoles=new_item['NetworkRoles'],
-                                   DataCenterLocation=new_item['DataCenterLocation'],
-                                   DataCenterLocationId=new_item['DataCenterLocationId'])
-
-            hosts_list.append(host)
+        if not total_hosts and not since:
+            raise Exception('CMDB unreachable')
 
         if dev:
             print('!!! DEV !!!')
-            print(f'Total hosts: {len(cmdb_hosts)}')
-            print(cmdb_hosts[0])
+            print(f'Total hosts: {total_hosts}')
+            print(first_item)
             print('!!! DEV END !!!')
         return hosts_list
 
+    async def _get_pages(self, query: str, page_size: int) -> Tuple[list, int, Dict | None, int | None]:
+        """Reads pages until an empty one.
+
+        Returns (hosts, raw hosts count, first raw host, None), or the server's page size
+        in the last place when a short page turns out not to be the last one: the hosts
+        read so far have gaps then.
+        """
+        hosts_list = []
+        total_hosts = 0
+        first_item = None
+        short_page = None
+        page = 0
+        while True:
+            pages = await asyncio.gather(*(
+                self._get_cmdb_items(query=f"{query}&$top={page_size}&$skip={(page + i) * page_size}")
+                for i in range(CMDB_PAGE_CONCURRENCY)
+            ))
+            page += CMDB_PAGE_CONCURRENCY
+            for result in pages:
+                if result is None:
+                    raise Exception('CMDB unreachable')
+                cmdb_hosts, next_link = result
+                # only an empty page ends the list, a short one may be a server-side cap
+                if not cmdb_hosts:
+                    return hosts_list, total_hosts, first_item, None
+                if short_page is not None or (next_link and len(cmdb_hosts) < page_size):
+                    return hosts_list, total_hosts, first_item, short_page or len(cmdb_hosts)
+                if len(cmdb_hosts) < page_size:
+                    short_page = len(cmdb_hosts)
+                if first_item is None:
+                    first_item = cmdb_hosts[0]
+                total_hosts += len(cmdb_hosts)
+                hosts_list.extend(host for host in map(self._get_host, cmdb_hosts) if host)
+
+    @staticmethod
+    def _get_host(item: Dict) -> CMDBNetworkHost | None:
+        new_item = {key: value for key, value in item.items() if key not in ['Interfaces']}
+        new_item['Interfaces'] = ','.join(ip_dict.get('Ip') for ip_dict in item['Interfaces'] if
+                                          ip_dict['Ip'] is not None)
+        if isinstance(item['NetworkRoles'], list):
+            new_item['NetworkRoles'] = ','.join(item['NetworkRoles'])
+        if not new_item['NetworkRoles']:
+            return None
+        if '_' in new_item['HostName']:
+            new_item['HostName'] = new_item['HostName'].split('_')[0]
+
+        return CMDBNetworkHost(HostName=new_item['HostName'],
+                               NodeMember=new_item['NodeMember'],
+                               Status=new_item['Status'],
+                               Interfaces=new_item.get('Interfaces'),
+                               HardwareModelName=new_item['HardwareModelName'],
+                               OrgUnitName=new_item['OrgUnitName'],
+                               NetworkType=new_item['NetworkType'],
+                               NetworkRoles=new_item['NetworkRoles'],
+                               DataCenterLocation=new_item['DataCenterLocation'],
+                               DataCenterLocationId=new_item['DataCenterLocationId'])
+
     async def fill_cmdb(self):
         from services.services import host_service
+        started_at = datetime.now(timezone.utc)
+        full = not (CMDB_MODIFIED_FIELD and self.last_sync and self.last_full_sync and
+                    started_at - self.last_full_sync < timedelta(hours=CMDB_FULL_SYNC_HOURS))
         try:
-            cmdb_host_objects: List[CMDBNetworkHost] = await self.get_cmdb_model_objects()
+            cmdb_host_objects: List[CMDBNetworkHost] = await self.get_cmdb_model_objects(
+                since=None if full else self.last_sync)
         except Exception as err:
             print(f'CMDB connection error [{self.get_cmdb_model_objects.__name__}]. {err}')
             return {'error': 'CMDB unreachable'}
-        if not cmdb_host_objects:
+        if full and not cmdb_host_objects:
             return {'error': 'CMDB unreachable'}
 
-        await host_service().add_hosts(cmdb_host_objects)
+        result = await host_service().add_hosts(cmdb_host_objects, full=full)
         await host_service().backup()
+        self.last_sync = started_at
+        if full:
+            self.last_full_sync = started_at
+        return {"total_hosts": len(cmdb_host_objects), "full": full, **result}
@@ -1,10 +1,91 @@
+import asyncio
+import weakref
 import aiohttp
 
+from typing import Any, Tuple
+from config import CONFIG
+from core.logger import logger
+
+
+HTTP_CONFIG = CONFIG.get('http', {})
+# connections kept alive per upstream, also the number of requests in flight
+HTTP_LIMIT = HTTP_CONFIG.get('limit') or 10
+HTTP_DNS_CACHE_TTL = HTTP_CONFIG.get('dns_cache_ttl') or 300
+# attempts after the first one, and the time they may take together
+HTTP_RETRIES = HTTP_CONFIG.get('retries', 3)
+HTTP_BACKOFF = HTTP_CONFIG.get('backoff') or 0.5
+HTTP_RETRY_BUDGET = HTTP_CONFIG.get('retry_budget') or 30
+
 
 class HTTPClient:
-    def __init__(self, base_url: str, params: dict = None):
+    """Client of one upstream with its own keep-alive connection pool.
+
+    The aiohttp session is created on first use inside the running loop and reused by
+    every request, so TCP/TLS setup and DNS lookups are paid once. Connection errors,
+    timeouts and 5xx answers are retried with exponential backoff within a time budget.
+    """
+    _instances = weakref.WeakSet()
+
+    def __init__(self, base_url: str, params: dict = None, limit: int = HTTP_LIMIT,
+                 retries: int = HTTP_RETRIES, backoff: float = HTTP_BACKOFF, retry_budget: float = HTTP_RETRY_BUDGET):
         self.base_url = base_url
         self.params = params if params else {}
+        self.limit = limit
+        self.retries = retries
+        self.backoff = backoff
+        self.retry_budget = retry_budget
+        self._session: aiohttp.ClientSession | None = None
+        self._semaphore: asyncio.Semaphore | None = None
+        HTTPClient._instances.add(self)
+
+    def get_session(self) -> aiohttp.ClientSession:
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(limit=self.limit,
+                                             use_dns_cache=True,
+                                             ttl_dns_cache=HTTP_DNS_CACHE_TTL)
+            self._session = aiohttp.ClientSession(connector=connector)
+            self._semaphore = asyncio.Semaphore(self.limit)
+        return self._session
+
+    async def request(self, method: str, url: str, **kwargs) -> Tuple[int, Any]:
+        """Sends the request and returns (status, decoded json body or None if status is not 200)."""
+        session = self.get_session()
+        kwargs = {**self.params, **kwargs}
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.retry_budget
+        attempt = 0
+        while True:
+            try:
+                async with self._semaphore:
+                    async with session.request(method, url, **kwargs) as response:
+                        status = response.status
+                        if status < 500:
+                            data = await response.json(content_type=None) if status == 200 else None
+                            return status, data
+                error = f"status {status}"
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as err:
+                status = None
+                error = err
+
+            delay = self.backoff * 2 ** attempt
+            attempt += 1
+            if attempt > self.retries or loop.time() + delay > deadline:
+                if status is None:
+                    raise error
+                return status, None
+            logger.warning(f"{method} {url} failed ({error}), retry {attempt}/{self.retries} in {delay:.1f}s")
+            await asyncio.sleep(delay)
+
+    async def close(self) -> None:
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+
+    @classmethod
+    async def close_all(cls) -> None:
+        for client in list(cls._instances):
+            await client.close()
+
 
 __all__ = (
     'HTTPClient',
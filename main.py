@@ -9,7 +9,9 @@ from starlette_admin.contrib.sqla import Admin, ModelView
 from contextlib import asynccontextmanager
 from db.models import Incidents, CMDBNetworkHost, Events
 from db.init_db import init_db
-from dependencies import cmdb_client
+from dependencies import cmdb_client, click_pool
+from dependencies.http_interface import HTTPClient
+from core.redis_client import redis_client
 
 warnings.simplefilter('always', ResourceWarning)
 
@@ -20,6 +22,9 @@ async def lifespan(app: FastAPI):
     await cmdb_client.fill_cmdb()
     yield
     # release resources here
+    await click_pool.close()
+    await HTTPClient.close_all()
+    await redis_client.close()
     await engine.dispose()
 
 
@@ -0,0 +1,109 @@
+from __future__ import annotations
+
+import asyncio
+
+from typing import Dict, List, NamedTuple, Tuple
+from config import CONFIG
+from core.logger import logger
+from network.connection import ConnectionFabric
+from network.state_cache import interface_states
+
+__all__ = ('ActionResult',
+           'DeviceActionBatcher',
+           'port_batcher',
+           )
+
+# interface actions of a device collected within this many seconds share one commit
+NETWORK_BATCH_WINDOW = CONFIG['network'].get('batch_window') or 2
+NETWORK_BATCH_SIZE = CONFIG['network'].get('batch_size') or 50
+# interfaces already in the target state are reported as done instead of configured again
+NETWORK_CHECK_STATE = CONFIG['network'].get('check_state', True)
+
+
+class ActionResult(NamedTuple):
+    host: str
+    interface: str
+    ok: bool
+    error: str | None = None
+
+
+class DeviceActionBatcher:
+    """Coalesces interface actions per (device type, host, action).
+
+    The first action of a device opens a window, actions arriving within it are applied
+    together: one configuration session, one commit. Each caller gets the result of its
+    own interface.
+    """
+
+    def __init__(self, window: float = NETWORK_BATCH_WINDOW, max_size: int = NETWORK_BATCH_SIZE):
+        self.window = window
+        self.max_size = max_size
+        self._pending: Dict[Tuple[str, str, str], List[Tuple[str, asyncio.Future]]] = {}
+        self._flushes: Dict[Tuple[str, str, str], asyncio.Task] = {}
+
+    async def submit(self, device_type: str, host: str, interface: str, action: str = "down") -> ActionResult:
+        key = (device_type, host, action)
+        future = asyncio.get_running_loop().create_future()
+        pending = self._pending.setdefault(key, [])
+        pending.append((interface, future))
+        if len(pending) >= self.max_size:
+            waiting = self._flushes.pop(key, None)
+            if waiting is not None:
+                waiting.cancel()
+            self._flushes[key] = asyncio.create_task(self._flush_later(key, delay=0))
+        elif key not in self._flushes:
+            self._flushes[key] = asyncio.create_task(self._flush_later(key))
+        return await future
+
+    async def _flush_later(self, key: Tuple[str, str, str], delay: float = None) -> None:
+        await asyncio.sleep(self.window if delay is None else delay)
+        if self._flushes.get(key) is asyncio.current_task():
+            del self._flushes[key]
+        await self._flush(key)
+
+    async def _flush(self, key: Tuple[str, str, str]) -> None:
+        device_type, host, action = key
+        batch = self._pending.pop(key, [])
+        if not batch:
+            return None
+        errors = None
+        try:
+            errors = await self._apply(device_type, host, action, [interface for interface, _ in batch])
+        except Exception as err:
+            # whatever went wrong, no submitter is left waiting
+            logger.exception(f'{host}: batch failed: {err}')
+            errors = {interface: str(err) for interface, _ in batch}
+        finally:
+            for interface, future in batch:
+                if not future.done():
+                    error = errors.get(interface) if errors is not None else 'Batch is cancelled'
+                    future.set_result(ActionResult(host, interface, error is None, error))
+
+    @staticmethod
+    async def _apply(device_type: str, host: str, action: str, interfaces: List[str]) -> Dict[str, str | None]:
+        interfaces = list(dict.fromkeys(interfaces))
+        logger.info(f'{host}: {action} {len(interfaces)} interfaces in one commit: {interfaces}')
+        conn = ConnectionFabric(device_type, host)
+        errors = {}
+        if NETWORK_CHECK_STATE:
+            try:
+                # one snapshot of the device serves the checks of the whole batch
+                snapshot = await interface_states.get(conn)
+                done = [interface for interface in interfaces if interface_states.in_state(snapshot, interface, action)]
+                if done:
+                    logger.info(f'{host}: already {action}: {done}')
+                errors = {interface: None if interface in done else interface_states.check(snapshot, interface, action)
+                          for interface in interfaces}
+                interfaces = [interface for interface in interfaces
+                              if errors[interface] is None and interface not in done]
+            except Exception as err:
+                logger.error(f'{host}: interface states are unknown, acting without the check: {err}')
+        if interfaces:
+            try:
+                errors.update(await conn.set_interfaces(interfaces, action=action))
+            except Exception as err:
+                logger.error(f'{host}: batch of {len(interfaces)} interfaces failed: {err}')
+                errors.update({interface: str(err) for interface in interfaces})
+        return errors
+
+port_batcher = DeviceActionBatcher()
@@ -1,10 +1,12 @@
 from __future__ import annotations
 
-import sys
-
+from typing import Dict, Tuple
 from netmiko.juniper.juniper import JuniperSSH
 from config import CONFIG
 from core.logger import logger
+from network.sessions import device_sessions
+from network.state_cache import interface_states
+from network.netconf import JuniperNetconfConnection
 
 __all__ = ('ConnectionFabric',
            'JuniperConnection',
@@ -12,45 +14,87 @@ __all__ = ('ConnectionFabric',
 
 
 class JuniperConnection:
+    """Junos over SSH (netmiko), on the warm sessions of network.sessions."""
 
     def __init__(self, host, *args, **kwargs):
         self.host = host
         self.username = CONFIG['network']['username']
 
-    async def set_interface(self, interface, action="down", check_state=False):
-        action_map = {"down": "set", "up": "delete"}
+    @staticmethod
+    def connect(host) -> JuniperSSH:
+        return JuniperSSH(device_type='juniper_junos',
+                          host=host,
+                          username=CONFIG['network']['username'],
+                          allow_agent=True, use_keys=False)
+
+    @staticmethod
+    def is_alive(conn: JuniperSSH) -> bool:
+        return conn.is_alive()
+
+    @staticmethod
+    def disconnect(conn: JuniperSSH) -> None:
+        conn.disconnect()
+
+    async def get_interface_states(self) -> Dict[str, Tuple[str, str]]:
+        """{interface: (admin status, link status)} of all interfaces, from one `show interfaces terse`."""
+        return await device_sessions.run(JuniperConnection, self.host, self._get_interface_states)
+
+    async def set_interface(self, interface, action="down", check_state=False) -> dict:
+        if check_state:
+            error = interface_states.check(await interface_states.get(self), interface, action)
+            if error:
+                logger.error(f"WARNING --- interface: {interface} of switch: {self.host}: {error}")
+                return {interface: error}
+        return await self.set_interfaces([interface], action=action)
+
+    async def set_interfaces(self, interfaces, action="down") -> dict:
+        """Sets `action` on all interfaces in one configure exclusive and one commit.
+
+        Returns {interface: error or None}. An interface whose command is rejected does
+        not stop the others, a failed commit raises for all of them.
+        """
         try:
-            with JuniperSSH(device_type='juniper_junos',
-                            host=self.host,
-                            username=self.username,
-                            allow_agent=True, use_keys=False) as conn:
-                if check_state:
-                    command = f"show int {interface} brief | display xml | match admin-status"
-                    show_output = conn.send_command(command)
-                    logger.debug(show_output)
-                    if action == "up" and "up" in show_output:
-                        logger.error("WARNING --- interface: ", interface, "of switch: ", self.host, "is already UP")
-                        sys.exit("Interface is already UP")
-                    if action == "down" and "down" in show_output:
-                        logger.error("WARNING --- interface: ", interface, "of switch: ", self.host, "is already DOWN")
-                        sys.exit("Interface is already DOWN")
-                config_command = f"{action_map[action]} interfaces {interface} disable"
-                logger.debug("do command: ", config_command)
-                conn.config_mode(config_command="configure exclusive")
-                if conn.check_config_mode():
-                    print('Enter config mode...')
-                    shutdown_output = conn.send_command(command_string=config_command, expect_string=r".*#", read_timeout=60)
-                    print("output:\n", shutdown_output)
-                    save_config_output = conn.commit(and_quit=True, read_timeout=60)
-                    print(save_config_output)
-                conn.disconnect()
+            return await device_sessions.run(JuniperConnection, self.host, self._set_interfaces,
+                                             list(interfaces), action)
         except Exception as e:
-            raise Exception(f'Cannot connect to switch: {self.host}')
+            raise Exception(f'Cannot configure switch: {self.host}: {e}') from e
+        finally:
+            interface_states.invalidate(self.host)
+
+    @staticmethod
+    def _get_interface_states(conn: JuniperSSH) -> Dict[str, Tuple[str, str]]:
+        states = {}
+        # Interface  Admin  Link  Proto  Local  Remote
+        for line in conn.send_command("show interfaces terse").splitlines():
+            parts = line.split()
+            if len(parts) >= 3 and parts[1] in ('up', 'down') and parts[2] in ('up', 'down'):
+                states[parts[0]] = (parts[1], parts[2])
+        return states
+
+    @staticmethod
+    def _set_interfaces(conn: JuniperSSH, interfaces, action) -> dict:
+        action_map = {"down": "set", "up": "delete"}
+        results = {}
+        conn.config_mode(config_command="configure exclusive")
+        if not conn.check_config_mode():
+            raise Exception('Cannot enter configuration mode')
+        for interface in interfaces:
+            config_command = f"{action_map[action]} interfaces {interface} disable"
+            output = conn.send_command(command_string=config_command, expect_string=r".*#", read_timeout=60)
+            logger.debug(f"{config_command}: {output}")
+            results[interface] = output.strip() if 'error' in output.lower() or 'invalid' in output.lower() else None
+        if all(results.values()):
+            conn.exit_config_mode()
+            return results
+        save_config_output = conn.commit(and_quit=True, read_timeout=60)
+        logger.debug(f"commit: {save_config_output}")
+        return results
 
 
 class ConnectionFabric:
     CLASS_MAPPER = {
-        'juniper_junos': JuniperConnection
+        'juniper_junos': JuniperConnection,
+        'juniper_netconf': JuniperNetconfConnection,
     }
 
     def __new__(cls, device_type, host, *args, **kwargs):
@@ -0,0 +1,137 @@
+from __future__ import annotations
+
+import time
+
+from typing import Dict, Tuple
+from ncclient import manager
+from ncclient.operations import RPCError
+from ncclient.xml_ import new_ele, sub_ele
+from config import CONFIG
+from core.logger import logger
+from network.sessions import device_sessions
+from network.state_cache import interface_states
+
+__all__ = ('JuniperNetconfConnection',
+           )
+
+NETCONF_PORT = CONFIG['network'].get('netconf_port') or 830
+NETCONF_TIMEOUT = CONFIG['network'].get('netconf_timeout') or 60
+# verifying host keys needs known_hosts on the worker, a local test server has none
+NETCONF_HOSTKEY_VERIFY = CONFIG['network'].get('hostkey_verify', False)
+# the device rolls the change back by itself unless it is confirmed within this many seconds
+NETCONF_CONFIRM_TIMEOUT = CONFIG['network'].get('confirm_timeout') or 120
+# seconds after the commit before the device is probed over a new session
+NETCONF_PROBE_DELAY = CONFIG['network'].get('probe_delay') or 3
+
+_DISABLE_CONFIG = {
+    "down": '<disable/>',
+    "up": '<disable xc:operation="delete"/>',
+}
+
+
+class JuniperNetconfConnection:
+    """Junos over NETCONF (ncclient), on the warm sessions of network.sessions.
+
+    State is read as structured XML and changes are made with edit-config on the locked
+    candidate and `commit confirmed`, confirmed only after a new session to the device has
+    answered a get; otherwise the device rolls the change back by itself. The
+    port and credentials come from the config, so it can be pointed at a local server.
+    """
+
+    def __init__(self, host, *args, **kwargs):
+        self.host = host
+        self.username = CONFIG['network']['username']
+
+    @staticmethod
+    def connect(host) -> manager.Manager:
+        return manager.connect(host=host,
+                               port=NETCONF_PORT,
+                               username=CONFIG['network']['username'],
+                               password=CONFIG['network'].get('password'),
+                               hostkey_verify=NETCONF_HOSTKEY_VERIFY,
+                               allow_agent=True,
+                               look_for_keys=False,
+                               timeout=NETCONF_TIMEOUT,
+                               device_params={'name': 'junos'})
+
+    @staticmethod
+    def is_alive(conn: manager.Manager) -> bool:
+        return conn.connected
+
+    @staticmethod
+    def disconnect(conn: manager.Manager) -> None:
+        conn.close_session()
+
+    async def get_interface_states(self) -> Dict[str, Tuple[str, str]]:
+        """{interface: (admin status, oper status)} of all physical and logical interfaces."""
+        return await device_sessions.run(JuniperNetconfConnection, self.host, self._get_interface_states)
+
+    async def set_interface(self, interface, action="down", check_state=False):
+        if check_state:
+            error = interface_states.check(await interface_states.get(self), interface, action)
+            if error:
+                logger.error(f"WARNING --- interface: {interface} of switch: {self.host}: {error}")
+                return {interface: error}
+        return await self.set_interfaces([interface], action=action)
+
+    async def set_interfaces(self, interfaces, action="down") -> dict:
+        """Sets `action` on all interfaces with one confirmed commit, returns {interface: error or None}."""
+        try:
+            return await device_sessions.run(JuniperNetconfConnection, self.host, self._set_interfaces,
+                                             self.host, list(interfaces), action)
+        except Exception as e:
+            raise Exception(f'Cannot configure switch: {self.host}: {e}') from e
+        finally:
+            interface_states.invalidate(self.host)
+
+    @staticmethod
+    def _get_interface_states(conn: manager.Manager) -> Dict[str, Tuple[str, str]]:
+        rpc = new_ele('get-interface-information')
+        sub_ele(rpc, 'terse')
+        reply = conn.rpc(rpc)
+        states = {}
+        for item in reply.xpath('//physical-interface | //logical-interface'):
+            name = (item.findtext('name') or '').strip()
+            if name:
+                states[name] = ((item.findtext('admin-status') or '').strip(),
+                                (item.findtext('oper-status') or '').strip())
+        return states
+
+    @staticmethod
+    def _interface_config(interface, action) -> str:
+        return f'<config xmlns:xc="urn:ietf:params:xml:ns:netconf:base:1.0">' \
+               f'<configuration><interfaces><interface>' \
+               f'<name>{interface}</name>{_DISABLE_CONFIG[action]}' \
+               f'</interface></interfaces></configuration></config>'
+
+    @staticmethod
+    def _probe(host) -> None:
+        time.sleep(NETCONF_PROBE_DELAY)
+        with JuniperNetconfConnection.connect(host) as probe:
+            JuniperNetconfConnection._get_interface_states(probe)
+
+    @staticmethod
+    def _set_interfaces(conn: manager.Manager, host, interfaces, action) -> dict:
+        results = {}
+        with conn.locked(target='candidate'):
+            try:
+                for interface in interfaces:
+                    # one edit-config per interface, a rejected one does not take the others down
+                    try:
+                        conn.edit_config(target='candidate', config=JuniperNetconfConnection._interface_config(interface, action))
+                        results[interface] = None
+                    except RPCError as err:
+                        results[interface] = str(err)
+                if all(results.values()):
+                    conn.discard_changes()
+                    return results
+                conn.commit(confirmed=True, timeout=str(NETCONF_CONFIRM_TIMEOUT))
+                # a change that cut the management access off fails the probe and is rolled
+                # back by the device, only a device that still answers gets the confirmation
+                JuniperNetconfConnection._probe(host)
+                conn.commit()
+            except Exception:
+                if conn.connected:
+                    conn.discard_changes()
+                raise
+        return results
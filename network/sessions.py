@@ -0,0 +1,157 @@
+from __future__ import annotations
+
+import time
+import asyncio
+
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict
+from config import CONFIG
+from core.logger import logger
+
+__all__ = ('DeviceSession',
+           'DeviceSessionManager',
+           'device_sessions',
+           )
+
+# blocking driver calls in flight at once, over all devices
+NETWORK_WORKERS = CONFIG['network'].get('max_workers') or 8
+# a session unused for this long is logged out
+NETWORK_SESSION_IDLE = CONFIG['network'].get('session_idle_seconds') or 300
+
+
+class DeviceSession:
+    """Connection to one device and the lock which serializes the work on it.
+
+    `driver` opens and checks the connection: connect(host), is_alive(connection),
+    disconnect(connection), all blocking.
+    """
+
+    def __init__(self, driver: Any, host: str):
+        self.driver = driver
+        self.host = host
+        self.connection: Any = None
+        self.lock = asyncio.Lock()
+        self.last_used = time.monotonic()
+
+
+class DeviceSessionManager:
+    """Warm driver sessions per (driver, host) for the asyncio code.
+
+    netmiko and ncclient are blocking, so logins and commands run in the manager's bounded
+    thread pool and never stall the event loop. A session is reused by the next action on
+    the same host after a health check, broken sessions are dropped and opened again, idle
+    ones are closed by a reaper task.
+    """
+
+    def __init__(self, max_workers: int = NETWORK_WORKERS, idle_timeout: float = NETWORK_SESSION_IDLE):
+        self.idle_timeout = idle_timeout
+        self.max_workers = max_workers
+        self._executor: ThreadPoolExecutor | None = None
+        self._sessions: Dict[tuple, DeviceSession] = {}
+        self._reaper: asyncio.Task | None = None
+
+    def _submit(self, func: Callable, *args) -> asyncio.Future:
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='network')
+        return asyncio.get_running_loop().run_in_executor(self._executor, func, *args)
+
+    async def _to_thread(self, func: Callable, *args) -> Any:
+        return await self._submit(func, *args)
+
+    async def run(self, driver: Any, host: str, func: Callable, *args) -> Any:
+        """Runs func(connection, *args) in the pool on the warm session of `driver` to `host`.
+
+        Actions on one host are serialized, actions on different hosts run in parallel.
+        The host stays locked until the thread is done with the connection, even when the
+        awaiting task is cancelled (a cron job timeout), the result is discarded then.
+        """
+        self._start_reaper()
+        key = (driver.__name__, host)
+        session = self._sessions.get(key)
+        if session is None:
+            session = self._sessions[key] = DeviceSession(driver, host)
+        await session.lock.acquire()
+        try:
+            future = self._submit(self._work, session, func, *args)
+        except BaseException:
+            session.lock.release()
+            raise
+
+        def release(_):
+            session.last_used = time.monotonic()
+            session.lock.release()
+
+        future.add_done_callback(release)
+        return await asyncio.shield(future)
+
+    @staticmethod
+    def _work(session: DeviceSession, func: Callable, *args) -> Any:
+        # runs in a thread with the host locked: health check, (re)connect and the action
+        if session.connection is not None and not DeviceSessionManager._check(session):
+            logger.info(f'Session to {session.host} is dead, reconnecting...')
+            DeviceSessionManager._disconnect(session)
+        if session.connection is None:
+            session.connection = session.driver.connect(session.host)
+            logger.info(f'Session to {session.host} is open')
+        try:
+            return func(session.connection, *args)
+        except Exception:
+            # the state of the session is unknown after an error
+            DeviceSessionManager._disconnect(session)
+            raise
+
+    @staticmethod
+    def _check(session: DeviceSession) -> bool:
+        try:
+            return session.driver.is_alive(session.connection)
+        except Exception:
+            return False
+
+    @staticmethod
+    def _disconnect(session: DeviceSession) -> None:
+        connection, session.connection = session.connection, None
+        if connection is None:
+            return None
+        try:
+            session.driver.disconnect(connection)
+        except Exception as err:
+            logger.error(f'Cannot close session to {session.host}: {err}')
+
+    async def _drop(self, session: DeviceSession) -> None:
+        if session.connection is not None:
+            await self._to_thread(self._disconnect, session)
+
+    def _start_reaper(self) -> None:
+        if self._reaper is None or self._reaper.done():
+            self._reaper = asyncio.create_task(self._reap())
+
+    async def _reap(self) -> None:
+        while True:
+            await asyncio.sleep(self.idle_timeout / 2)
+            await self.evict_idle()
+
+    async def evict_idle(self) -> None:
+        now = time.monotonic()
+        for session in list(self._sessions.values()):
+            if session.connection is None or session.lock.locked() or now - session.last_used < self.idle_timeout:
+                continue
+            # the session object stays, its lock keeps serializing the host
+            async with session.lock:
+                if session.connection is not None:
+                    logger.info(f'Session to {session.host} is idle, closing...')
+                    await self._drop(session)
+
+    async def close(self) -> None:
+        if self._reaper is not None:
+            self._reaper.cancel()
+            self._reaper = None
+        for session in list(self._sessions.values()):
+            async with session.lock:
+                await self._drop(session)
+        self._sessions.clear()
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+
+device_sessions = DeviceSessionManager()
@@ -0,0 +1,69 @@
+from __future__ import annotations
+
+import time
+import asyncio
+
+from typing import Any, Dict, Tuple
+from config import CONFIG
+from core.logger import logger
+
+__all__ = ('InterfaceStateCache',
+           'interface_states',
+           )
+
+# a snapshot of a device serves the pre-checks for this many seconds
+NETWORK_STATE_TTL = CONFIG['network'].get('state_ttl') or 30
+
+
+class InterfaceStateCache:
+    """Snapshots of {interface: (admin status, oper status)} per device.
+
+    A snapshot is taken with one call for all ports of the device (`show interfaces terse`
+    or a NETCONF get) and shared by the pre-checks of every incident on it until it expires
+    or is invalidated by our own commit.
+    """
+
+    def __init__(self, ttl: float = NETWORK_STATE_TTL):
+        self.ttl = ttl
+        self._snapshots: Dict[str, Tuple[float, Dict[str, Tuple[str, str]]]] = {}
+        self._locks: Dict[str, asyncio.Lock] = {}
+
+    async def get(self, conn: Any) -> Dict[str, Tuple[str, str]]:
+        """Snapshot of the device of `conn`, a driver with host and get_interface_states()."""
+        snapshot = self._fresh(conn.host)
+        if snapshot is not None:
+            return snapshot
+        lock = self._locks.setdefault(conn.host, asyncio.Lock())
+        async with lock:
+            # concurrent pre-checks wait for the snapshot taken by the first one
+            snapshot = self._fresh(conn.host)
+            if snapshot is None:
+                snapshot = await conn.get_interface_states()
+                self._snapshots[conn.host] = (time.monotonic() + self.ttl, snapshot)
+                logger.info(f'Interface states of {conn.host}: {len(snapshot)} interfaces')
+        return snapshot
+
+    def _fresh(self, host: str) -> Dict[str, Tuple[str, str]] | None:
+        expires_at, snapshot = self._snapshots.get(host, (0, None))
+        return snapshot if expires_at > time.monotonic() else None
+
+    def invalidate(self, host: str) -> None:
+        self._snapshots.pop(host, None)
+
+    @staticmethod
+    def in_state(snapshot: Dict[str, Tuple[str, str]], interface: str, action: str) -> bool:
+        """The interface is already where `action` would take it."""
+        return snapshot.get(interface, (None, None))[0] == action
+
+    @staticmethod
+    def check(snapshot: Dict[str, Tuple[str, str]], interface: str, action: str) -> str | None:
+        """Returns why `action` must not be done on the interface, None if it may."""
+        admin_status = snapshot.get(interface, (None, None))[0]
+        if admin_status is None:
+            return f"Interface {interface} is not found"
+        if admin_status == action:
+            return f"Interface is already {action.upper()}"
+        return None
+
+
+interface_states = InterfaceStateCache()
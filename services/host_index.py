@@ -0,0 +1,77 @@
+import asyncio
+
+from typing import Dict, NamedTuple
+from datetime import datetime, timedelta
+from db.service_repository import HostsRepository
+from core.roles import resolve_role
+from core.logger import logger
+from config import CONFIG
+
+
+__all__ = ('HostEntry',
+           'HostIndex',
+           'host_index',
+           )
+
+# a process which missed the sync reloads the index after this many seconds
+HOST_INDEX_MAX_AGE = CONFIG.get('host_index', {}).get('max_age') or 3900
+
+
+class HostEntry(NamedTuple):
+    hostname: str
+    status: str
+    roles: str | None  # NetworkRoles as they are in CMDB
+    role: str | None  # effective role, see resolve_role
+    model: str
+
+
+class HostIndex:
+    """CMDB hosts by hostname, kept in process memory.
+
+    The whole mapping is built aside and swapped in with one assignment, so readers always
+    see a complete version. `version` is bumped by every refresh.
+    """
+
+    def __init__(self, max_age: float = HOST_INDEX_MAX_AGE):
+        self.max_age = max_age
+        self.version = 0
+        self.loaded_at: datetime | None = None
+        self._hosts: Dict[str, HostEntry] = {}
+        self._lock: asyncio.Lock | None = None
+
+    def get(self, hostname: str) -> HostEntry | None:
+        return self._hosts.get(hostname)
+
+    def __contains__(self, hostname: str) -> bool:
+        return hostname in self._hosts
+
+    def __len__(self) -> int:
+        return len(self._hosts)
+
+    @property
+    def stale(self) -> bool:
+        return self.loaded_at is None or datetime.now() - self.loaded_at > timedelta(seconds=self.max_age)
+
+    async def refresh(self) -> int:
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            rows = await HostsRepository().index_rows()
+            hosts = {hostname: HostEntry(hostname, status, roles, resolve_role(roles), model)
+                     for hostname, status, roles, model in rows}
+            self._hosts = hosts
+            self.version += 1
+            self.loaded_at = datetime.now()
+        logger.info(f'Host index v{self.version}: {len(hosts)} hosts')
+        return self.version
+
+    async def ensure_fresh(self) -> "HostIndex":
+        if self.stale:
+            try:
+                await self.refresh()
+            except Exception as err:
+                logger.error(f'Host index refresh failed: {err}')
+        return self
+
+
+host_index = HostIndex()
@@ -1,10 +1,13 @@
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Iterable, Tuple
+from datetime import datetime
 from sqlalchemy.engine.result import ScalarResult
 
-from db.models import SQLModel, Events, EventsUnknown
+from db.models import SQLModel, Events
 from db.service_repository import Incidents, IncidentsRepository, EventsRepository, HostsRepository
 from network.connection import ConnectionFabric
 from dependencies.click_repo import ClickRepository
+from services.host_index import host_index
+from core.redis_client import dedup_index
 from core.logger import logger
 
 
@@ -29,7 +32,11 @@ class IncidentService:
         return inc
 
     async def fetch_incidents(self) -> List[Dict[str, Any]]:
-        return await self.repo.get_incidents()
+        hosts = await host_index.ensure_fresh()
+        # an empty index (no sync yet) falls back to the join
+        incidents = await self.repo.get_incidents(hosts if len(hosts) else None)
+        await dedup_index.mark_active(incidents)
+        return incidents
 
     async def push_to_cache(self) -> List[Dict[str, Any]]:
         return await self.repo.push_cache()
@@ -52,8 +59,25 @@ class IncidentService:
     async def get_incidents_as_dict_with_filter(self, **filter_by) -> List[Dict[str, Any]] | None:
         return await self.repo.get_all_as_dict_with_filter(**filter_by)
 
-    async def update(self, inc: SQLModel) -> bool:
-        return await self.repo.update(inc)
+    async def update(self, inc: SQLModel, fields: Iterable[str] = None, check_version: bool = False) -> bool:
+        return await self.repo.update(inc, fields=fields, check_version=check_version)
+
+    async def claim_incidents(self, owner: str, limit: int, lease_seconds: int, uuids: Iterable = None) -> List[Dict[str, Any]]:
+        return await self.repo.claim(owner, limit, lease_seconds, uuids=uuids)
+
+    async def renew_lease(self, inc: Dict[str, Any], owner: str, lease_seconds: int) -> bool:
+        return await self.repo.renew_lease(inc, owner, lease_seconds)
+
+    async def is_duplicate(self, inc: Incidents) -> bool:
+        """Another incident of the interface is active or was handled within the dedup window."""
+        known = await dedup_index.lookup([(inc.hostname, inc.interface)])
+        if known is None:
+            return await self.repo.exists_other(inc, window=dedup_index.window)
+        value = known.get((inc.hostname, inc.interface))
+        return value is not None and value != str(inc.event_id)
+
+    async def update_stages(self, inc: Incidents, fields: Iterable[str], stages: List[Tuple[str, datetime]]) -> bool:
+        return await self.repo.update_stages(inc, fields, stages)
 
 
 class HostService:
@@ -63,12 +87,13 @@ class HostService:
     async def add_host(self, cmdb_host: SQLModel) -> SQLModel | None:
         return await self.repo.add_one(cmdb_host, filter_by={"NetworkType": "Switch"})
 
-    async def add_hosts(self, cmdb_hosts: List[SQLModel]) -> None:
-        for cmdb_host in cmdb_hosts:
-            await self.repo.add_one(cmdb_host, filter_by={"NetworkType": "Switch"})
+    async def add_hosts(self, cmdb_hosts: List[SQLModel], full: bool = True) -> Dict[str, int]:
+        switches = [cmdb_host for cmdb_host in cmdb_hosts if cmdb_host.NetworkType == "Switch"]
+        return await self.repo.sync(switches, full=full)
 
     async def backup(self):
         await self.repo.backup()
+        await host_index.refresh()
 
 
 class EventService:
@@ -78,28 +103,16 @@ class EventService:
     async def add_event(self, event: SQLModel) -> SQLModel | None:
         return await self.repo.add_one(event)
 
-    async def add_events(self, events: List[SQLModel]) -> List[Dict[str, Any]]:   # ,  incident_srv=Annotated[IncidentService, Depends(incident_service)]
+    async def add_events(self, events: List[SQLModel]) -> List[Dict[str, Any]]:
         logger.info(f"EVENTS LEN: {len(events)}")
-        events_list = []
-        for event in events:
-            inc_exists: Incidents = await incident_service().find_incident(event.hostname, event.interface)
-            if not inc_exists:
-                logger.info(f">>> >>> Add event: {event}")
-                if await self.repo.add_one(event):  # filter_by={"link_type": "P"}
-                    event_dict = event.model_dump(exclude={"id"})
-                    events_list.append(event_dict)
-                else:
-                    logger.info(f">>> >>> Found old incident: {inc_exists}")
-                    if self.repo.model_unknown:
-                        event_data = event.model_dump(exclude={"uuid"}, exclude_unset=True)
-                        event_unknown = EventsUnknown().sqlmodel_update(event_data)
-                        print(f">>>  >>>  >>>  EVENT FAILED: {event_unknown}")
-                        # filter_by =
-                        if not await self.repo.get_one_as_dict_with_filter(model=self.repo.model_unknown,
-                                                                           hostname=event_unknown.hostname,
-                                                                           interface=event_unknown.interface):
-                            await self.repo.add_one(event_unknown)
-        return events_list
+        # interfaces with an active or recently handled incident, None sends the check to postgres
+        known = await dedup_index.lookup((event.hostname, event.interface) for event in events)
+        if known is not None:
+            events = [event for event in events if (event.hostname, event.interface) not in known]
+            logger.info(f"Events suppressed by dedup index: {len(known)} interfaces")
+        added_events = await self.repo.add_many(events, check_incidents=known is None)
+        logger.info(f">>> >>> Added events: {len(added_events)}")
+        return [event.model_dump(exclude={"id"}) for event in added_events]
 
     async def delete_this_event(self, filter_by: dict) -> Events | None:
         return await self.repo.delete_explicit(**filter_by)
@@ -114,9 +127,30 @@ class EventService:
 
 
 def click_service() -> ClickRepository:
-    from config import CONFIG
-    return ClickRepository(url=CONFIG['clickhouse']['host'],
-                           port=CONFIG['clickhouse']['port'])
+    from dependencies import click_pool
+    return ClickRepository(pool=click_pool)
+
+
+async def collect_events(click_srv: ClickRepository, event_srv: EventService) -> Dict[str, Any]:
+    events: List[Events] = await click_srv.get_events_inerrors()
+
+    if events is None:
+        return {"success": False,
+                "error": "Connection error to clickhouse"}
+    if not events:
+        await click_srv.commit_state()
+        return {"success": True,
+                "found": 0,
+                "applied": 0,
+                "message": "New events are not found"}
+    logger.info(f"Total events: {len(events)}")
+    events_added = await event_srv.add_events(events)
+    # the watermark moves on only after the events are stored
+    await click_srv.commit_state()
+    return {"success": True,
+            "found": len(events),
+            "applied": len(events_added),
+            "message": "Some events are not added" if len(events_added) < len(events) else "All events are added"}
 
 
 def event_service() -> "EventService":
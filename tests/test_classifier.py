@@ -0,0 +1,65 @@
+from itertools import product
+
+from core.classifier import classify, classify_many
+from core.roles import Role
+
+# NetworkRoles values as they come from CMDB, a few hosts carry several roles
+ROLES = ('edge', 'ddos_edge', 'edge_hadoop', 'edge_hosting', 'ext_edge',
+         'core', 'ext_core', 'core_tarm_lan', 'core_p',
+         'aggregate', 'aggregate_hosting', 'border', 'cache', 'office', '',
+         'aggregate,edge', 'core,border', 'core,aggregate', 'border,edge', 'edge,cache', 'edge,leaf')
+HOSTNAMES = ('dc1-spine-01', 'dc1-leaf-07', 'msk-core-01')
+LINK_TYPES = ('P', 'U', 'I')
+
+
+def _legacy_classify(hostname, peer, link_type, role_h, role_p):
+    # the rules of ClassifiedSingleHandler._set_incident_classname before the lookup table,
+    # evaluated in source order
+    edge_roles = ('edge', 'edge_minion', 'ddos_edge', 'edge_hadoop', 'edge_hosting', 'ext_edge')
+    core_roles = ('core', 'ext_core', 'core_tarm_lan', 'core_p')
+    aggregate_roles = ('aggregate', 'aggregate_hosting')
+    border_roles = ('border',)
+    cache_roles = ('cache',)
+    all_roles = edge_roles + core_roles + aggregate_roles + border_roles
+
+    if len(role_h.split(',')) > 1:
+        role_h = Role(max(Role[role].value if role in all_roles else 0 for role in role_h.split(','))).name
+    if len(role_p.split(',')) > 1:
+        role_p = Role(max(Role[role].value if role in all_roles else 0 for role in role_p.split(','))).name
+
+    conditions = (
+        ('peer_uplink', lambda: link_type == 'P'),
+        ('aggregate_spine', lambda: (role_h in aggregate_roles and 'spine' in peer) or
+                                    ('spine' in hostname and role_p in aggregate_roles)),
+        ('spine_leaf', lambda: ('spine' in hostname and 'leaf' in peer) or
+                               ('leaf' in hostname and 'spine' in peer)),
+        ('core_aggregate__access', lambda: (role_h in edge_roles and role_p in core_roles) or
+                                           (role_h in core_roles and role_p in edge_roles) or
+                                           (role_h in edge_roles and role_p in aggregate_roles) or
+                                           (role_h in aggregate_roles and role_p in edge_roles)),
+        ('core__cache', lambda: (role_h in core_roles and role_p in cache_roles) or
+                                (role_h in cache_roles and role_p in core_roles)),
+        ('core_aggregate_border', lambda: (role_h in core_roles and role_p in aggregate_roles) or
+                                          (role_h in aggregate_roles and role_p in core_roles) or
+                                          (role_h in core_roles and role_p in border_roles) or
+                                          (role_h in border_roles and role_p in core_roles) or
+                                          (role_h in core_roles and role_p in core_roles) or
+                                          (role_h in border_roles and role_p in border_roles)),
+    )
+    classname = next((name for name, condition in conditions if condition()), 'unclassified')
+    return classname, role_h, role_p
+
+
+def _fixture():
+    return [dict(hostname=hostname, peer=peer, link_type=link_type, role_h=role_h, role_p=role_p)
+            for hostname, peer, link_type, role_h, role_p in product(HOSTNAMES, HOSTNAMES, LINK_TYPES, ROLES, ROLES)]
+
+
+def test_classify_matches_legacy_rules():
+    for incident in _fixture():
+        assert classify(**incident) == _legacy_classify(**incident), incident
+
+
+def test_classify_many_matches_classify():
+    incidents = _fixture()
+    assert classify_many(incidents) == [classify(**incident) for incident in incidents]
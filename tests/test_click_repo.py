@@ -0,0 +1,145 @@
+import os
+import re
+import math
+import shutil
+import subprocess
+
+from collections import defaultdict
+from datetime import datetime
+
+import pytest
+
+from dependencies.click_repo import ClickRepository, MAX_INERRORS_COUNTS, MAX_INERRORS_THRESHOLD_LIMIT
+
+HIGH = MAX_INERRORS_THRESHOLD_LIMIT + 10
+LOW = 0
+TIME_START = int(datetime(2024, 11, 20, 12, 0).timestamp())
+# the single clickhouse binary runs the real query on the fixture, without a server
+CLICKHOUSE_LOCAL = shutil.which('clickhouse')
+
+
+def _series(path, values, start=TIME_START, step=60):
+    return [(path, float(value), start + i * step) for i, value in enumerate(values)]
+
+
+def _fixture():
+    run = [HIGH] * MAX_INERRORS_COUNTS
+    rows = []
+    # a run reaching the limit, another one after a reset
+    rows += _series('sw1.interfaces.ge-0/0/1.-U-_sw2_ge-0/0/1.InErrors', run + [LOW] + run)
+    # a reset one sample short of the limit
+    rows += _series('sw1.interfaces.ge-0/0/2.-U-_sw2_ge-0/0/2.InErrors', run[:-1] + [LOW] + run[:-1])
+    # the description changes within the run, the interface is still one series
+    rows += _series('sw1.interfaces.ge-0/0/3.-U-_sw2_ge-0/0/3.InErrors', run[:2])
+    rows += _series('sw1.interfaces.ge-0/0/3.-P-_sw3_ge-0/0/3.InErrors', run, start=TIME_START + 120)
+    # non-finite values count as 0
+    rows += _series('sw2.interfaces.ge-0/0/5.-I-_sw1_ge-0/0/5.InErrors', run[:2] + [math.nan] + run + [math.inf] + run)
+    # service interfaces never produce events
+    rows += _series('sw2.interfaces.Vlanif100.-U-_sw1_Vlanif100.InErrors', run)
+    return sorted(rows, key=lambda row: row[2])
+
+
+def _query_semantics(query):
+    """The grouping key, the step rules and the hit condition as written in the generated SQL."""
+    assert re.search(r"GROUP BY Interface\s+HAVING Interface != ''", query)
+    assert 'arraySort(x -> x.2, groupArray((Value, Timestamp, Path)))' in query
+    assert 'arrayCumSumNonNegative(steps)' in query
+    assert 'SELECT hit.3 AS Path, hit.1 AS Value, hit.2 AS Timestamp' in query
+    return dict(key=re.search(r"extract\(Path, '([^']*)'\) AS Interface", query).group(1),
+                description=re.search(r"extract\(x\.3, '([^']*)'\)", query).group(1),
+                threshold=float(re.search(r"NOT isFinite\(x\.1\) OR round\(x\.1\) < ([\d.]+), -1000000000", query).group(1)),
+                link_type=re.search(r"= 'None' OR NOT match\(.*?'\), '([^']*)'\), 0", query).group(1),
+                count=int(re.search(r"run = (\d+) AND step = 1", query).group(1)))
+
+
+def _aggregate(rows, query):
+    # evaluates the generated query on the rows step by step, with the patterns and limits taken from it
+    semantics = _query_semantics(query)
+    samples = defaultdict(list)
+    for path, value, timestamp in rows:
+        match = re.match(semantics['key'], path)
+        if match:
+            samples[match.group(1)].append((value, timestamp, path))
+    hits = []
+    for items in samples.values():
+        run = 0
+        for value, timestamp, path in sorted(items, key=lambda item: item[1]):
+            description = (re.match(semantics['description'], path) or [None, ''])[1]
+            if not math.isfinite(value) or round(value) < semantics['threshold']:
+                step = -1000000000
+            elif description == 'None' or not re.search(semantics['link_type'], description):
+                step = 0
+            else:
+                step = 1
+            run = max(run + step, 0)
+            if run == semantics['count'] and step == 1:
+                hits.append((path, value, timestamp))
+    return sorted(hits, key=lambda hit: hit[2])
+
+
+def _query(rows):
+    date_filter = f"Date = '{datetime.fromtimestamp(TIME_START).strftime('%Y-%m-%d')}'"
+    return ClickRepository._inerrors_aggregate_query(date_filter, TIME_START - 1, rows[-1][2] + 1)
+
+
+def _clickhouse_local(query, rows):
+    # stdin is the table `table` of clickhouse-local
+    data = ''.join(f'{datetime.fromtimestamp(ts).date()}\t{path}\t{value}\t{ts}\n' for path, value, ts in rows)
+    output = subprocess.run([CLICKHOUSE_LOCAL, 'local',
+                             '--structure', 'Date Date, Path String, Value Float64, Timestamp UInt32',
+                             '--input-format', 'TSV', '--output-format', 'TSV',
+                             '--query', query.replace('default.distributed_net_graphite', 'table')],
+                            input=data, capture_output=True, text=True, check=True).stdout
+    hits = []
+    for line in output.splitlines():
+        path, value, timestamp = line.split('\t')
+        hits.append((path, float(value), int(timestamp)))
+    return hits
+
+
+def _clickhouse_server(query, rows):
+    from clickhouse_driver import Client
+
+    table = 'default.shutdowner_test_graphite'
+    client = Client(os.environ['CLICKHOUSE_TEST_HOST'], port=int(os.environ.get('CLICKHOUSE_TEST_PORT', 9000)))
+    client.execute(f'DROP TABLE IF EXISTS {table}')
+    client.execute(f'CREATE TABLE {table} (Date Date, Path String, Value Float64, Timestamp UInt32) ENGINE = Memory')
+    try:
+        client.execute(f'INSERT INTO {table} (Date, Path, Value, Timestamp) VALUES',
+                       [(datetime.fromtimestamp(ts).date(), path, value, ts) for path, value, ts in rows])
+        return client.execute(query.replace('default.distributed_net_graphite', table))
+    finally:
+        client.execute(f'DROP TABLE IF EXISTS {table}')
+
+
+def _stream_events(rows):
+    inerrors_count = defaultdict(int)
+    events = [ClickRepository._check_inerrors_metric(*row, inerrors_count) for row in rows]
+    return [event for event in events if event]
+
+
+def _aggregate_events(hits):
+    events = [ClickRepository._check_inerrors_candidate(*hit) for hit in hits]
+    return [event for event in events if event]
+
+
+def _key(event):
+    return event.hostname, event.interface, event.description, event.link_type, event.peer, event.value, event.created_at
+
+
+def test_aggregate_query_semantics_match_stream():
+    rows = _fixture()
+    stream = sorted(_key(event) for event in _stream_events(rows))
+    aggregate = sorted(_key(event) for event in _aggregate_events(_aggregate(rows, _query(rows))))
+    assert stream
+    assert aggregate == stream
+
+
+@pytest.mark.skipif(not (CLICKHOUSE_LOCAL or os.environ.get('CLICKHOUSE_TEST_HOST')),
+                    reason='neither clickhouse-local nor CLICKHOUSE_TEST_HOST is available')
+def test_aggregate_query_matches_stream():
+    rows = _fixture()
+    run = _clickhouse_local if CLICKHOUSE_LOCAL else _clickhouse_server
+    hits = run(_query(rows), rows)
+    stream = sorted(_key(event) for event in _stream_events(rows))
+    assert sorted(_key(event) for event in _aggregate_events(hits)) == stream